@@ -1,4 +1,3 @@
-import json
 import logging
 import sys
 import random
@@ -8,20 +7,27 @@ import asyncio
 from datetime import datetime
 from json import JSONDecodeError
 
+import orjson
 import uvicorn
 
-from settings import Settings
-from uvicorn import Config, Server
-
-from fastapi import FastAPI, Request, HTTPException, BackgroundTasks, Response
+from fastapi import FastAPI, APIRouter, Depends, Request, HTTPException, BackgroundTasks, Response
 from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.openapi.utils import get_openapi
-from fastapi.encoders import jsonable_encoder
 from fastapi.staticfiles import StaticFiles
-
-from database import MovementDoc, Entity, Big, Contragent, Object, Place, Port, DocType, Package, EntityClass, \
-    TransportType, serialize_collection
+from starlette.concurrency import run_in_threadpool, iterate_in_threadpool
+from sqlalchemy.exc import SQLAlchemyError
+
+from database import MovementDoc, Entity, Big, Contragent, Object, Place, Port, DocType, Package, \
+    TransportType, Revision, IngestJob, serialize_collection, serialize_docs, changed_fields, session, request_scope, \
+    Stock, DOCS_REVISION, JOB_DONE, JOB_FAILED, ENTITY_FILTERS, ENTITY_SORT, STOCK_GROUPS, get_config, get_engine, \
+    get_session, session_scope
+from cache import reference_cache
+from changes import change_broker, CHANGES_BUFFER, CHANGES_POLL, CHANGES_HEARTBEAT, CHANGES_MAX_CLIENTS
+from ingest import ingest_queue, build_doc, create_job, INGEST_QUEUE_SIZE, INGEST_WORKERS, INGEST_RETENTION_DAYS, \
+    INGEST_STALE_MINUTES
+from responses import FastJSONResponse, CompressionMiddleware, dumps
+from metrics import MetricsMiddleware, instrument_engine, render as render_metrics
 
 from logs import get_logger
 
@@ -40,24 +46,41 @@ class_table = {
     'transport': TransportType
 }
 
-app = FastAPI(title="Proton Backend")
+for _key, _model in class_table.items():
+    reference_cache.register(_key, _model.__tablename__, lambda model=_model: serialize_collection(model.get_all()))
+
+DOC_PAGE_SIZE = 100
+DOC_PAGE_LIMIT = 1000
+ENTITY_PAGE_SIZE = 100
+SUGGEST_LIMIT = 10
+SUGGEST_LIMIT_MAX = 50
+
+
+class SessionScopeMiddleware(object):
+    """
+    Отдельная сессия БД на каждый запрос, закрывается после отправки ответа и фоновых задач.
+    """
+
+    def __init__(self, app):
+        self.app = app
 
-# app.mount("/static", StaticFiles(directory='static'), name='static')
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        token = request_scope.set(object())
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            await run_in_threadpool(session.remove)
+            request_scope.reset(token)
 
-origins = [
-    "*"
-]
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=origins,
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+# Маршруты работают только в области запроса, которую открывает SessionScopeMiddleware
+router = APIRouter(dependencies=[Depends(get_session)])
 
 
-def custom_openapi():
+def custom_openapi(app):
     if app.openapi_schema:
         return app.openapi_schema
     openapi_schema = get_openapi(
@@ -73,10 +96,195 @@ def custom_openapi():
     return app.openapi_schema
 
 
-app.openapi = custom_openapi
+def warm_reference_cache():
+    with session_scope():
+        try:
+            reference_cache.warm()
+        except SQLAlchemyError as e:
+            # Пустая база не мешает старту: справочники загрузятся первым запросом после миграций
+            LOGGER.log(logging.WARNING, msg="Reference cache is not warmed, run migrations.py: %s" % e.args)
+
+
+def load_revisions():
+    with session_scope():
+        return Revision.all()
+
+
+def revision_changed(counter):
+    """
+    Счетчик ревизий, который изменил другой процесс (воркер uvicorn, importer.py): сброс кэша
+    справочника и имена событий ленты изменений.
+    """
+    if counter == DOCS_REVISION:
+        return [DOCS_REVISION]
+    reference_cache.invalidate(counter)
+    return reference_cache.keys(counter)
+
+
+async def startup():
+    instrument_engine(get_engine())
+    await run_in_threadpool(warm_reference_cache)
+    config = get_config()
+    change_broker.start(load_revisions, revision_changed,
+                        poll=config.get_float('changes', 'poll', CHANGES_POLL),
+                        buffer=config.get_int('changes', 'buffer', CHANGES_BUFFER))
+    await ingest_queue.start(size=config.get_int('ingest', 'queue_size', INGEST_QUEUE_SIZE),
+                             workers=config.get_int('ingest', 'workers', INGEST_WORKERS),
+                             retention=config.get_int('ingest', 'retention_days', INGEST_RETENTION_DAYS),
+                             stale=config.get_int('ingest', 'stale_minutes', INGEST_STALE_MINUTES))
+
+
+async def shutdown():
+    await ingest_queue.stop()
+    await change_broker.stop()
+
+
+def create_app():
+    """
+    Фабрика приложения: ``uvicorn --factory app:create_app``.
+
+    Настройки читаются при вызове, движок БД создается при старте приложения, соединение
+    открывается первым запросом. Схема БД при этом не создается - для этого ``python migrations.py``.
+    """
+    config = get_config()
+    reference_cache.ttl = config.get_float('cache', 'ttl')
+
+    app = FastAPI(title="Proton Backend", default_response_class=FastJSONResponse)
+    app.state.changes_heartbeat = config.get_float('changes', 'heartbeat', CHANGES_HEARTBEAT)
+    app.state.changes_max_clients = config.get_int('changes', 'max_clients', CHANGES_MAX_CLIENTS)
+
+    # app.mount("/static", StaticFiles(directory='static'), name='static')
+
+    origins = [
+        "*"
+    ]
+
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=origins,
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+    app.add_middleware(SessionScopeMiddleware)
+    app.add_middleware(CompressionMiddleware, minimum_size=config.get_int('compression', 'minimum_size', 1024))
+    app.add_middleware(MetricsMiddleware,
+                       query_headers=config.get_bool('monitoring', 'query_headers'),
+                       query_budget=config.get_int('monitoring', 'query_budget'))
+    app.include_router(router)
+    app.openapi = lambda: custom_openapi(app)
+    app.add_event_handler("startup", startup)
+    app.add_event_handler("shutdown", shutdown)
+    return app
+
+
+_app = None
+
+
+def get_app():
+    global _app
+    if _app is None:
+        _app = create_app()
+    return _app
+
+
+def __getattr__(name):
+    # ``uvicorn app:app`` и ``from app import app`` создают приложение при первом обращении, не при импорте
+    if name == 'app':
+        return get_app()
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+def query_int(request, name):
+    value = request.query_params.get(name)
+    if value is None or value == '':
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise HTTPException(400, detail="Некорректный параметр %s" % name)
+
+
+def query_ids(request, name):
+    value = request.query_params.get(name)
+    if value is None or value == '':
+        return None
+    try:
+        return [int(_) for _ in value.split(',') if _]
+    except ValueError:
+        raise HTTPException(400, detail="Некорректный параметр %s" % name)
+
+
+def query_date(request, name):
+    value = request.query_params.get(name)
+    if value is None or value == '':
+        return None
+    try:
+        return datetime.strptime(value, "%Y-%m-%d")
+    except ValueError:
+        raise HTTPException(400, detail="Некорректный параметр %s" % name)
+
+
+def not_modified(request, etag):
+    header = request.headers.get('if-none-match')
+    if not header:
+        return False
+    if header.strip() == '*':
+        return True
+    tags = [_.strip() for _ in header.split(',')]
+    return etag.replace('W/', '') in [_.replace('W/', '') for _ in tags]
+
+
+def not_modified_response(etag):
+    return Response(status_code=304, headers={'ETag': etag})
+
+
+def wants_ndjson(request):
+    if request.query_params.get('format') == 'ndjson':
+        return True
+    return 'application/x-ndjson' in request.headers.get('accept', '')
+
+
+async def read_json(request):
+    request_body = b''
+    async for chunk in request.stream():
+        request_body += chunk
+    try:
+        # orjson разбирает большие документы в несколько раз быстрее json
+        return orjson.loads(request_body)
+    except JSONDecodeError:
+        raise HTTPException(400, detail="Некорректный JSON")
+
+
+def load_docs(after=None, limit=None):
+    if after is None and limit is None:
+        data = MovementDoc.get_all()
+    else:
+        data = MovementDoc.get_page(after, limit)
+    return serialize_docs(data)
+
+
+def load_doc(doc_id):
+    doc = MovementDoc.get(doc_id)
+    return doc.serialized if doc else None
+
+
+async def stream_docs(after=None, limit=None):
+    sent = 0
+    page_size = DOC_PAGE_SIZE if limit is None else min(limit, DOC_PAGE_SIZE)
+    while True:
+        page = await run_in_threadpool(load_docs, after, page_size)
+        if not page:
+            return
+        for _ in page:
+            yield dumps(_) + b'\n'
+            sent += 1
+            if limit is not None and sent >= limit:
+                return
+        after = page[-1]['id']
 
 
-@app.get("/api/v1/ping")
+@router.get("/api/v1/ping")
 async def ping():
     """
     Понг блять.
@@ -84,26 +292,120 @@ async def ping():
 
     :return:
     """
-    return jsonable_encoder(dict(alive=True))
+    return FastJSONResponse(dict(alive=True))
 
 
-@app.get("/api/v1/entity/{entity_id}")
-async def entity_info(entity_id):
+@router.get("/metrics", include_in_schema=False)
+async def metrics():
+    """
+    Метрики Prometheus.
+    """
+    data, content_type = render_metrics()
+    return Response(data, media_type=content_type)
+
+
+def search_entities(params):
+    return serialize_collection(Entity.search(**params))
+
+
+@router.get("/api/v1/entity")
+async def entity_search(request: Request):
+    """
+    Поиск грузопозиций.
+
+    Фильтры на точное совпадение: ``name``, ``segment_number``, ``pipe_tag``, ``package``, ``big``,
+    ``place_number``, ``input_doc``, ``output_doc``. Даты входящего документа: ``date_from``/``date_to``
+    по дате приемки, ``sent_from``/``sent_to`` по дате отправки, в формате ``2021-09-01``.
+
+    Сортировка ``?sort=weight&order=desc``, по умолчанию по id. Страница задается ``limit`` и
+    ``offset``, при сортировке по id вместо ``offset`` передается ``after=<последний id>``.
+    Параметры следующей страницы возвращаются в заголовке ``X-Next-After`` или ``X-Next-Offset``.
+
+    :param request:
+    :return:
+    """
+    filters = {}
+    for name, kind in ENTITY_FILTERS.items():
+        value = request.query_params.get(name)
+        if value is None or value == '':
+            continue
+        filters[name] = query_int(request, name) if kind is int else value
+    sort = request.query_params.get('sort') or 'id'
+    if sort not in ENTITY_SORT:
+        raise HTTPException(400, detail="Некорректный параметр sort")
+    order = request.query_params.get('order') or 'asc'
+    if order not in ('asc', 'desc'):
+        raise HTTPException(400, detail="Некорректный параметр order")
+    after = query_int(request, 'after')
+    if after is not None and sort != 'id':
+        raise HTTPException(400, detail="Параметр after доступен только при сортировке по id")
+    offset = max(query_int(request, 'offset') or 0, 0)
+    limit = query_int(request, 'limit')
+    limit = ENTITY_PAGE_SIZE if limit is None else min(max(limit, 1), DOC_PAGE_LIMIT)
+    params = dict(
+        filters=filters,
+        date_from=query_date(request, 'date_from'),
+        date_to=query_date(request, 'date_to'),
+        sent_from=query_date(request, 'sent_from'),
+        sent_to=query_date(request, 'sent_to'),
+        sort=sort,
+        descending=order == 'desc',
+        after=after,
+        offset=offset,
+        limit=limit
+    )
+    data = await run_in_threadpool(search_entities, params)
+    headers = {}
+    if len(data) == limit and sort == 'id':
+        headers['X-Next-After'] = str(data[-1]['id'])
+    elif len(data) == limit:
+        headers['X-Next-Offset'] = str(offset + limit)
+    return FastJSONResponse(data, headers=headers)
+
+
+@router.get("/api/v1/entity/suggest")
+async def entity_suggest(request: Request):
+    """
+    Подсказки для ввода номера сегмента или метки трубы: ``?q=SEG-0001&limit=10``.
+
+    Ищет по номеру сегмента, метке трубы, классу и доп. информации, отдает id, segment_number,
+    pipe_tag и name. Запросы короче двух символов возвращают пустой список.
+
+    :param request:
+    :return:
+    """
+    value = request.query_params.get('q') or ''
+    limit = query_int(request, 'limit')
+    limit = SUGGEST_LIMIT if limit is None else min(max(limit, 1), SUGGEST_LIMIT_MAX)
+    data = await run_in_threadpool(Entity.suggest, value, limit)
+    return FastJSONResponse(data)
+
+
+@router.get("/api/v1/entity/{entity_id}")
+async def entity_info(request: Request, entity_id):
     """
     Получить развернутую информацию по грузопозиции.
 
+    Поддерживает условный запрос: ``ETag`` в ответе, ``If-None-Match`` в запросе, 304 без тела.
+
     :param entity_id:
     :return:
     """
-    entity = Entity.get(entity_id)
+    revision = await run_in_threadpool(Entity.get_revision, entity_id)
+    if revision is None:
+        return FastJSONResponse(dict(reason="Not Found"), status_code=404)
+    etag = '"entity-%s-%s"' % (entity_id, revision)
+    if not_modified(request, etag):
+        return not_modified_response(etag)
+    entity = await run_in_threadpool(Entity.get, entity_id)
     if not entity:
-        return Response(json.dumps(dict(reason="Not Found")), status_code=404)
+        return FastJSONResponse(dict(reason="Not Found"), status_code=404)
     else:
-        return jsonable_encoder(entity.serialized)
+        return FastJSONResponse(entity.serialized, headers={'ETag': etag})
 
 
-@app.get("/api/v1/properties/{property}")
-async def get_properties(property):
+@router.get("/api/v1/properties/{property}")
+async def get_properties(request: Request, property):
     """
     Метод для получения справочных элементов.
 
@@ -125,25 +427,277 @@ async def get_properties(property):
 
     'transport': Виды транспорта
 
+    Справочники отдаются из кэша в памяти процесса, время жизни задается параметром ``ttl``
+    секции ``[cache]`` настроек.
+
     :param property:
     :return:
     """
-    collection = class_table[property].get_all()
-    data = serialize_collection(collection)
-    return jsonable_encoder(data)
+    if property not in class_table:
+        return FastJSONResponse(dict(reason="Not Found"), status_code=404)
+    entry = reference_cache.peek(property)
+    if entry is None:
+        entry = await run_in_threadpool(reference_cache.get, property)
+    data, etag = entry
+    if not_modified(request, etag):
+        return not_modified_response(etag)
+    return Response(data, media_type="application/json", headers={'ETag': etag})
+
+
+@router.get("/api/v1/stock")
+async def stock(request: Request):
+    """
+    Остатки на складе: количество, вес и fu грузопозиций без расходного документа.
+
+    По умолчанию сгруппированы по ``big``, ``entity_class`` и ``place`` (место приходного документа),
+    ``?group=big,place`` - другой набор группировок, ``?group=`` - общий итог. Фильтры ``big``,
+    ``entity_class``, ``place``. Отдает ``ETag``, на ``If-None-Match`` возвращается 304.
+
+    :param request:
+    :return:
+    """
+    group = request.query_params.get('group')
+    group = STOCK_GROUPS if group is None else [_ for _ in group.split(',') if _]
+    if any(_ not in STOCK_GROUPS for _ in group):
+        raise HTTPException(400, detail="Некорректный параметр group")
+    filters = {}
+    for name in STOCK_GROUPS:
+        if request.query_params.get(name):
+            filters[name] = request.query_params[name] if name == 'entity_class' else query_int(request, name)
+    revision = await run_in_threadpool(Revision.current, DOCS_REVISION)
+    etag = 'W/"stock-%s"' % revision
+    if not_modified(request, etag):
+        return not_modified_response(etag)
+    data = await run_in_threadpool(Stock.summary, group, filters)
+    return FastJSONResponse(data, headers={'ETag': etag})
+
+
+@router.get("/api/v1/export")
+async def export(request: Request):
+    """
+    Выгрузка документов движения с грузопозициями, одна строка на грузопозицию.
 
+    ``?format=csv|xlsx|parquet`` (по умолчанию csv), фильтры ``date_from``/``date_to`` по дате приемки
+    и ``type`` - id типа документа. Строки читаются из БД порциями и сразу отдаются клиенту, XLSX
+    совместим с importer.py. Для parquet на сервере должен быть установлен pyarrow.
 
-@app.get("/api/v1/doc")
-@app.get("/api/v1/doc/{doc_id}")
-@app.put("/api/v1/doc")
-@app.patch("/api/v1/doc/{doc_id}")
-@app.delete("/api/v1/doc/{doc_id}")
+    :param request:
+    :return:
+    """
+    # pandas и openpyxl нужны только выгрузке, не загружаем их при старте воркера
+    from export import export_chunks, EXPORT_FORMATS, pyarrow
+
+    fmt = request.query_params.get('format') or 'csv'
+    if fmt not in EXPORT_FORMATS:
+        raise HTTPException(400, detail="Некорректный параметр format")
+    if fmt == 'parquet' and pyarrow is None:
+        return FastJSONResponse(dict(error=True, message="Parquet export requires pyarrow"), status_code=501)
+    chunks = export_chunks(fmt, query_date(request, 'date_from'), query_date(request, 'date_to'),
+                           query_int(request, 'type'))
+    filename = 'export-%s.%s' % (datetime.now().strftime('%Y%m%d-%H%M%S'), fmt)
+    return StreamingResponse(iterate_in_threadpool(chunks), media_type=EXPORT_FORMATS[fmt],
+                             headers={'Content-Disposition': 'attachment; filename="%s"' % filename})
+
+
+def create_doc(message):
+    req = message
+    if "entities" not in req or len(req["entities"]) == 0:
+        return FastJSONResponse(dict(reason="Empty entities"), status_code=500)
+    try:
+        doc, entities = build_doc(req)
+        doc.save_with_entities(entities)
+        LOGGER.log(logging.INFO, msg="Created doc %s with %s entities" % (doc.id, len(entities)))
+        return FastJSONResponse(doc.serialized)
+    except KeyError as e:
+        return FastJSONResponse(dict(missing_key=e.args))
+    except Exception as e:
+        return FastJSONResponse(dict(error=True, details=e.args), status_code=500)
+
+
+def wants_async(request):
+    if request.query_params.get('async') in ('1', 'true'):
+        return True
+    return 'respond-async' in request.headers.get('prefer', '')
+
+
+def job_response(job):
+    """
+    202 для задания в очереди или в работе, 200 для завершенного (повтор с тем же Idempotency-Key).
+    """
+    headers = {'Location': '/api/v1/job/%s' % job['id']}
+    if job['status'] in (JOB_DONE, JOB_FAILED):
+        return FastJSONResponse(job, headers=headers)
+    return FastJSONResponse(job, status_code=202, headers=headers)
+
+
+async def submit_doc(request, message):
+    """
+    Фоновая загрузка документа: тело проверяется сразу, запись - воркером ingest_queue.
+    """
+    if ingest_queue.full():
+        return FastJSONResponse(dict(error=True, message="Ingest queue is full"), status_code=503,
+                                headers={'Retry-After': '5'})
+    key = request.headers.get('idempotency-key') or None
+    try:
+        job, created = await run_in_threadpool(create_job, message, key)
+    except (KeyError, ValueError, TypeError, AttributeError) as e:
+        return FastJSONResponse(dict(error=True, details=e.args), status_code=400)
+    if created and not ingest_queue.submit(job['id']):
+        # Очередь заполнилась, пока записывалось задание: повтор с тем же ключом создаст его заново
+        await run_in_threadpool(IngestJob.discard, job['id'])
+        return FastJSONResponse(dict(error=True, message="Ingest queue is full"), status_code=503,
+                                headers={'Retry-After': '5'})
+    return job_response(job)
+
+
+def load_job(job_id):
+    job = IngestJob.get(job_id)
+    return job.serialized if job else None
+
+
+def update_doc(doc_id, message):
+    doc = MovementDoc.get(doc_id)
+    if not doc:
+        return FastJSONResponse(dict(error=True, message="Not Found"), status_code=404)
+    try:
+        req = message
+        fields = changed_fields(doc, dict(
+            type=req['type'],
+            port=req['port'],
+            sender=req['sender'],
+            receiver=req['receiver'],
+            place=req['place'],
+            transport_type=req['transport_type'],
+            object=req['object'],
+            danger_class=req["danger_class"],
+            big=req["big"],
+            transport_tag=req["transport_tag"],
+            tag=req["tag"],
+            send_date=datetime.strptime(req["send_date"], "%Y-%m-%d"),
+            receive_date=datetime.strptime(req["receive_date"], "%Y-%m-%d"),
+            extra=req["extra"],
+            contract=req["contract"]
+        ))
+        # Грузопозиции других документов не меняются: сводка остатков и ревизии считаются по документу
+        entities = {_.id: _ for _ in Entity.get_many((_['id'] for _ in req['entities']), doc_id=doc.id)}
+        changes = []
+        for _ in req['entities']:
+            entity = entities.get(int(_['id']))
+            if not entity:
+                return FastJSONResponse(dict(error=True, message="Entity %s Not Found" % _['id']),
+                                status_code=404)
+            values = changed_fields(entity, dict(
+                name=_['name'],
+                big=req['big'],
+                inplace_count=_['inplace_count'],
+                package=_['pipe_tag'],
+                weight=_['weight'],
+                height=_['length'],
+                segment_number=_['segment_number'],
+                diameter=_['diameter'],
+                thickness=_['thickness'],
+                place_number=_['place_number'],
+                extra=_['extra']
+            ))
+            if values:
+                values['id'] = entity.id
+                changes.append(values)
+        if fields or changes:
+            doc.save_changes(fields, changes)
+        return FastJSONResponse(dict(success=True, changed=len(changes), doc_changed=bool(fields)))
+    except KeyError as e:
+        return FastJSONResponse(dict(error=True, details=e.args), status_code=500)
+    except Exception as e:
+        return FastJSONResponse(dict(error=True, details=e.args), status_code=500)
+
+
+def delete_doc(doc_id):
+    doc = MovementDoc.get(doc_id)
+    if not doc:
+        return FastJSONResponse(dict(error=True, message="Not Found"), status_code=404)
+    try:
+        MovementDoc.delete_many([doc.id])
+        return FastJSONResponse(dict(success=True))
+    except KeyError as e:
+        return FastJSONResponse(dict(error=True, details=e.args), status_code=500)
+    except Exception as e:
+        return FastJSONResponse(dict(error=True, details=e.args), status_code=500)
+
+
+def delete_docs(ids, date_from, date_to):
+    try:
+        deleted = MovementDoc.delete_many(MovementDoc.select_ids(ids, date_from, date_to))
+        return FastJSONResponse(dict(success=True, deleted=deleted))
+    except KeyError as e:
+        return FastJSONResponse(dict(error=True, details=e.args), status_code=500)
+    except Exception as e:
+        return FastJSONResponse(dict(error=True, details=e.args), status_code=500)
+
+
+@router.get("/api/v1/changes")
+async def changes(request: Request):
+    """
+    Лента изменений (text/event-stream) вместо опроса /api/v1/doc и /api/v1/properties/* по таймеру.
+
+    Каждое событие - ``event: <имя>`` и ``data`` с JSON ``{"table", "op", "ids", "revision"}``:
+
+    - ``movement_doc`` - документ создан, изменен или удален (op insert, update, delete; change - запись
+      из другого процесса, без ids), revision совпадает с ревизией ETag списка документов;
+    - ``entity`` - отдельная грузопозиция, изменения грузопозиций документа приходят событием документа;
+    - справочник с op change под ключом /api/v1/properties/{key} (``big``, ``port``, ``type``,
+      ``transport``...) - справочник нужно перечитать, в том числе после импорта из importer.py.
+
+    ``event: reset`` - часть событий потеряна (клиент не успевал читать или переподключился слишком
+    поздно), данные нужно перечитать целиком. Браузерный EventSource при переподключении передает
+    ``Last-Event-ID``, и пропущенные события досылаются. Раз в heartbeat секунд приходит комментарий
+    ``: ping``.
+    """
+    if len(change_broker.subscribers) >= request.app.state.changes_max_clients:
+        return FastJSONResponse(dict(error=True, message="Too many change feed clients"), status_code=503,
+                                headers={'Retry-After': '30'})
+    events = change_broker.stream(request.headers.get('last-event-id'), request.app.state.changes_heartbeat)
+    return StreamingResponse(events, media_type="text/event-stream",
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@router.get("/api/v1/job/{job_id}")
+async def job_status(job_id):
+    """
+    Состояние задания фоновой загрузки документа: queued, running, done (doc - id созданного документа)
+    или failed (error - причина).
+    """
+    data = await run_in_threadpool(load_job, job_id)
+    if data is None:
+        return FastJSONResponse(dict(error=True, message="Not Found"), status_code=404)
+    return FastJSONResponse(data)
+
+
+@router.get("/api/v1/doc")
+@router.get("/api/v1/doc/{doc_id}")
+@router.put("/api/v1/doc")
+@router.patch("/api/v1/doc/{doc_id}")
+@router.delete("/api/v1/doc")
+@router.delete("/api/v1/doc/{doc_id}")
 async def process_doc(request: Request, doc_id=None):
     """
     Маршрут для обработки документа движения.
 
     Тип зависит от указанного в теле запроса, действие с документом зависит от метода запроса.
 
+    Список документов поддерживает постраничную выборку по id: ``?after=<последний id>&limit=<размер>``,
+    id для следующей страницы возвращается в заголовке ``X-Next-After``. При ``?format=ndjson`` или
+    ``Accept: application/x-ndjson`` документы отдаются потоком, по одному JSON на строку.
+
+    GET отдает ``ETag`` (для списка - общий для всей коллекции), на ``If-None-Match`` с тем же
+    значением возвращается 304 без тела.
+
+    ``PUT /api/v1/doc?async=1`` (или ``Prefer: respond-async``) проверяет тело и сразу отвечает 202 с
+    заданием, документ записывается в фоне, состояние - ``GET /api/v1/job/{id}`` (заголовок ``Location``).
+    С заголовком ``Idempotency-Key`` повтор запроса возвращает то же задание, а не второй документ.
+
+    ``DELETE /api/v1/doc`` удаляет документы пачкой вместе с грузопозициями: по списку
+    ``?ids=1,2,3`` и/или по дате приемки ``?date_from=2021-09-01&date_to=2021-09-30``.
+
 ``{
     "id": 30,
     "tag": "1",
@@ -191,162 +745,69 @@ async def process_doc(request: Request, doc_id=None):
     if request.method == "GET":
         LOGGER.log(logging.INFO, msg="Request doc %s" % doc_id)
         if not doc_id:
-            response = []
-            data = MovementDoc.get_all()
-            for _ in data:
-                response.append(_.serialized)
-            return jsonable_encoder(response)
+            after = query_int(request, 'after')
+            limit = query_int(request, 'limit')
+            if limit is not None:
+                limit = min(max(limit, 1), DOC_PAGE_LIMIT)
+            if wants_ndjson(request):
+                return StreamingResponse(stream_docs(after, limit), media_type="application/x-ndjson")
+            revision = await run_in_threadpool(Revision.current, DOCS_REVISION)
+            etag = 'W/"docs-%s"' % revision
+            if not_modified(request, etag):
+                return not_modified_response(etag)
+            if after is None and limit is None:
+                data = await run_in_threadpool(load_docs)
+                return FastJSONResponse(data, headers={'ETag': etag})
+            limit = limit or DOC_PAGE_SIZE
+            data = await run_in_threadpool(load_docs, after, limit)
+            response = FastJSONResponse(data, headers={'ETag': etag})
+            if len(data) == limit:
+                response.headers['X-Next-After'] = str(data[-1]['id'])
+            return response
         else:
-            data = MovementDoc.get(doc_id)
-            return jsonable_encoder(data)
+            revision = await run_in_threadpool(MovementDoc.get_revision, doc_id)
+            if revision is None:
+                return FastJSONResponse(dict(error=True, message="Not Found"), status_code=404)
+            etag = '"doc-%s-%s"' % (doc_id, revision)
+            if not_modified(request, etag):
+                return not_modified_response(etag)
+            data = await run_in_threadpool(load_doc, doc_id)
+            return FastJSONResponse(data, headers={'ETag': etag})
     elif request.method == 'PUT':
-        request_body = b''
-        async for chunk in request.stream():
-            request_body += chunk
-        try:
-            message = json.loads(request_body)
-        except JSONDecodeError:
-            raise HTTPException(400, detail="Некорректный JSON")
-        try:
-            req = message
-            if "entities" not in req or len(req["entities"]) == 0:
-                return Response(json.dumps(dict(reason="Empty entities")), status_code=500)
-            doc = MovementDoc(
-                type=req['type'],
-                port=req['port'],
-                sender=req['sender'],
-                receiver=req['receiver'],
-                place=req['place'],
-                transport_type=req['transport_type'],
-                object=req['object'],
-                danger_class=req["danger_class"],
-                big=req["big"],
-                transport_tag=req["transport_tag"],
-                tag=req["tag"],
-                send_date=datetime.strptime(req["send_date"], "%Y-%m-%d"),
-                receive_date=datetime.strptime(req["receive_date"], "%Y-%m-%d"),
-                extra=req["extra"],
-                contract=req["contract"]
-            )
-            doc.save()
-
-            to_doc = []
-            for _ in req["entities"]:
-                LOGGER.log(logging.INFO, msg="Process entity %s from doc %s" % (_["name"], doc.id))
-                entity_class = EntityClass.get_by_name(_["name"])
-                if not entity_class:
-                    _entity_class = EntityClass(name=_["name"])
-                    _entity_class.save()
-                if 'fu' in _:
-                    entity = Entity(
-                        name=_['name'],
-                        big=doc.big,
-                        inplace_count=_['inplace_count'],
-                        package=_['pipe_tag'],
-                        weight=_['weight'],
-                        height=_['length'],
-                        segment_number=_['segment_number'],
-                        diameter=_['diameter'],
-                        thickness=_['thickness'],
-                        place_number=_['place_number'],
-                        extra=_['extra'],
-                        fu=_['fu'],
-                        input_doc=doc.id
-                    )
-                    entity.save()
-                else:
-                    entity = Entity(
-                        name=_['name'],
-                        big=doc.big,
-                        inplace_count=_['inplace_count'],
-                        package=_['pipe_tag'],
-                        weight=_['weight'],
-                        height=_['length'],
-                        segment_number=_['segment_number'],
-                        diameter=_['diameter'],
-                        thickness=_['thickness'],
-                        place_number=_['place_number'],
-                        extra=_['extra'],
-                        input_doc=doc.id
-                    )
-                    entity.save()
-                LOGGER.log(logging.INFO, msg="Processed entity %s, %s" % (entity.name, entity.id))
-                to_doc.append(entity.id)
-            doc.entities = json.dumps(to_doc)
-            doc.save()
-            return jsonable_encoder(doc.serialized)
-        except KeyError as e:
-            doc.delete()
-            return json.dumps(dict(missing_key=e.args))
-        except Exception as e:
-            doc.delete()
-            return Response(json.dumps(dict(error=True, details=e.args)), status_code=500)
+        message = await read_json(request)
+        if wants_async(request):
+            return await submit_doc(request, message)
+        return await run_in_threadpool(create_doc, message)
     elif request.method == 'PATCH':
-        doc = MovementDoc.get(doc_id)
-        if doc:
-            request_body = b''
-            async for chunk in request.stream():
-                request_body += chunk
-            try:
-                message = json.loads(request_body)
-            except JSONDecodeError:
-                raise HTTPException(400, detail="Некорректный JSON")
-            try:
-                req = message
-                doc.type = req['type']
-                doc.port = req['port']
-                doc.sender = req['sender']
-                doc.receiver = req['receiver']
-                doc.place = req['place']
-                doc.transport_type = req['transport_type']
-                doc.object = req['object']
-                doc.danger_class = req["danger_class"]
-                doc.big = req["big"]
-                doc.transport_tag = req["transport_tag"]
-                doc.tag = req["tag"]
-                doc.send_date = datetime.strptime(req["send_date"], "%Y-%m-%d")
-                doc.receive_date = datetime.strptime(req["receive_date"], "%Y-%m-%d")
-                doc.extra = req["extra"]
-                doc.contract = req["contract"]
-                for _ in req['entities']:
-                    entity = Entity.get(_['id'])
-                    entity.name = _['name']
-                    entity.big = doc.big
-                    entity.inplace_count = _['inplace_count']
-                    entity.package = _['pipe_tag']
-                    entity.weight = _['weight']
-                    entity.height = _['length']
-                    if entity.segment_number != _['segment_number']:
-                        entity.segment_number = _['segment_number']
-                    entity.diameter = _['diameter']
-                    entity.thickness = _['thickness']
-                    entity.place_number = _['place_number']
-                    entity.extra = _['extra']
-                    entity.save(modify=True)
-                doc.save(modify=True)
-                return jsonable_encoder(dict(success=True))
-            except KeyError as e:
-                return Response(json.dumps(dict(error=True, details=e.args)), status_code=500)
-            except Exception as e:
-                return Response(json.dumps(dict(error=True, details=e.args)), status_code=500)
-        else:
-            return Response(json.dumps(dict(error=True, message="Not Found")), status_code=404)
+        message = await read_json(request)
+        return await run_in_threadpool(update_doc, doc_id, message)
     elif request.method == "DELETE":
-        doc = MovementDoc.get(doc_id)
-        if doc:
-            try:
-                for _ in json.loads(doc.entities):
-                    entity = Entity.get(int(_))
-                    entity.delete()
-                doc.delete()
-                return jsonable_encoder(dict(success=True))
-            except KeyError as e:
-                return Response(json.dumps(dict(error=True, details=e.args)), status_code=500)
-            except Exception as e:
-                return Response(json.dumps(dict(error=True, details=e.args)), status_code=500)
-        else:
-            return Response(json.dumps(dict(error=True, message="Not Found")), status_code=404)
+        if doc_id:
+            return await run_in_threadpool(delete_doc, doc_id)
+        ids = query_ids(request, 'ids')
+        date_from = query_date(request, 'date_from')
+        date_to = query_date(request, 'date_to')
+        if ids is None and date_from is None and date_to is None:
+            raise HTTPException(400, detail="Не указаны ids или диапазон дат")
+        return await run_in_threadpool(delete_docs, ids, date_from, date_to)
 
 
 if __name__ == '__main__':
-    uvicorn.run(app, host='0.0.0.0', port=8000)
+    # [server] workers > 1 - несколько процессов uvicorn. Каждый воркер сам вызывает create_app(),
+    # поэтому движок и пул соединений создаются после запуска процесса и не делятся между воркерами.
+    # Кэш справочников у каждого воркера свой: изменения из соседних процессов видны через [cache] ttl.
+    #
+    #     [server]
+    #     host = 0.0.0.0
+    #     port = 8000
+    #     workers = 4
+    #
+    # То же без этого модуля: uvicorn --factory app:create_app --workers 4
+    config = get_config()
+    workers = config.get_int('server', 'workers', 1)
+    if workers > 1 and not config.get_float('cache', 'ttl'):
+        LOGGER.log(logging.WARNING, msg="%s workers without [cache] ttl: reference changes are not seen "
+                                        "by other workers until restart" % workers)
+    uvicorn.run('app:create_app', factory=True, workers=workers,
+                host=config.get('server', 'host') or '0.0.0.0',
+                port=config.get_int('server', 'port', 8000))
@@ -0,0 +1,15 @@
+import os
+
+
+def configure(workdir, extra=''):
+    """
+    Настройки с отдельной SQLite базой во временном каталоге.
+
+    Вызывается до первого обращения к базе: настройки читаются при создании движка.
+    """
+    path = os.path.join(workdir, 'settings.conf')
+    with open(path, 'w') as file:
+        file.write('[database]\nengine = sqlite\nname = %s\n' % os.path.join(workdir, 'bench.db'))
+        file.write(extra)
+    os.environ['PROTON_CONFIG'] = path
+    return path
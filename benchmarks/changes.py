@@ -0,0 +1,127 @@
+"""
+Стоимость ленты изменений: память и CPU на неактивного клиента, задержка доставки события всем клиентам.
+
+    python -m benchmarks.changes --clients 500 --events 50
+
+Клиенты подключаются к /api/v1/changes через ASGI-интерфейс приложения в одном event loop.
+События публикуются из потока пула, как после commit в обработчике запроса; задержка - от публикации
+до получения события последним клиентом.
+"""
+import json
+import time
+import asyncio
+import argparse
+import resource
+import tempfile
+
+from starlette.concurrency import run_in_threadpool
+
+from benchmarks import configure
+
+
+def rss_mb():
+    with open('/proc/self/statm') as file:
+        return int(file.read().split()[1]) * resource.getpagesize() / (1024.0 * 1024.0)
+
+
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+class Client(object):
+    """
+    Подписчик /api/v1/changes: время получения каждого события по его id.
+    """
+
+    def __init__(self):
+        self.received = {}
+        self.stop = asyncio.Event()
+        self.task = None
+
+    async def run(self, app):
+        scope = dict(type='http', asgi=dict(version='3.0'), http_version='1.1', method='GET', scheme='http',
+                     path='/api/v1/changes', raw_path=b'/api/v1/changes', root_path='', query_string=b'',
+                     headers=[(b'host', b'bench')], client=('127.0.0.1', 50000), server=('bench', 80))
+        state = dict(sent=False)
+
+        async def receive():
+            if not state['sent']:
+                state['sent'] = True
+                return dict(type='http.request', body=b'', more_body=False)
+            await self.stop.wait()
+            return dict(type='http.disconnect')
+
+        async def send(message):
+            if message['type'] == 'http.response.body':
+                body = message.get('body', b'')
+                if body.startswith(b'id: '):
+                    self.received[body.split(b'\n', 1)[0][4:]] = time.perf_counter()
+
+        await app(scope, receive, send)
+
+
+async def measure(app, clients, events, idle):
+    from benchmarks.run import percentile
+    from changes import change_broker
+
+    await app.router.startup()
+    try:
+        rss_before = rss_mb()
+        subscribers = [Client() for _ in range(clients)]
+        for _ in subscribers:
+            _.task = asyncio.ensure_future(_.run(app))
+        while len(change_broker.subscribers) < clients:
+            await asyncio.sleep(0.01)
+        rss_connected = rss_mb()
+
+        cpu = cpu_seconds()
+        await asyncio.sleep(idle)
+        idle_cpu = cpu_seconds() - cpu
+
+        latencies = []
+        for number in range(events):
+            sequence = change_broker.sequence
+            published = time.perf_counter()
+            await run_in_threadpool(change_broker.publish, 'movement_doc', 'insert', [number], number)
+            event_id = change_broker.event_id(sequence + 1)
+            while not all(event_id in _.received for _ in subscribers):
+                await asyncio.sleep(0)
+            latencies.append(max(_.received[event_id] for _ in subscribers) - published)
+
+        for _ in subscribers:
+            _.stop.set()
+        await asyncio.gather(*[_.task for _ in subscribers])
+        return dict(
+            clients=clients,
+            rss_per_client_kb=round((rss_connected - rss_before) * 1024 / clients, 1),
+            idle_cpu_percent=round(idle_cpu / idle * 100, 2),
+            fanout_p50_ms=round(percentile(latencies, 50) * 1000, 2),
+            fanout_p95_ms=round(percentile(latencies, 95) * 1000, 2)
+        )
+    finally:
+        await app.router.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Стоимость ленты изменений")
+    parser.add_argument('--clients', type=int, default=500)
+    parser.add_argument('--events', type=int, default=50)
+    parser.add_argument('--idle', type=float, default=5.0, help="секунд без событий для замера CPU")
+    args = parser.parse_args()
+
+    configure(tempfile.mkdtemp(prefix='proton-bench-'),
+              '[changes]\nmax_clients = %s\n' % max(args.clients, 1000))
+
+    from database import init_db
+
+    init_db()
+
+    from app import app
+
+    result = asyncio.run(measure(app, args.clients, args.events, args.idle))
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
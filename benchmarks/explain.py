@@ -0,0 +1,110 @@
+"""
+Планы запросов поиска грузопозиций.
+
+    python -m benchmarks.explain
+
+Скрипт наполняет временную SQLite базу, собирает статистику ANALYZE и проверяет через
+EXPLAIN QUERY PLAN, что каждый фильтр GET /api/v1/entity выполняется по ожидаемому индексу
+без полного просмотра таблицы и без отдельной сортировки (USE TEMP B-TREE). При расхождении
+завершается с кодом 1.
+"""
+import re
+import sys
+import json
+import tempfile
+from datetime import datetime
+
+from benchmarks import configure
+
+# (индекс entity, ожидается сортировка, параметры Entity.search_query).
+# Сортировка допустима только там, где порядок по id не может дать ни один индекс: сортировка по другому
+# полю и диапазоны дат, где в ответ попадают грузопозиции нескольких документов. Сортируются только
+# найденные строки, а не таблица.
+CASES = (
+    ('ix_entity_name_id', False, dict(filters=dict(name='Труба 1'))),
+    ('ix_entity_name_big_id', False, dict(filters=dict(name='Труба 1', big=3))),
+    ('sqlite_autoindex_entity_1', False, dict(filters=dict(segment_number='SEG-00000010'))),
+    ('ix_entity_pipe_tag_id', False, dict(filters=dict(pipe_tag='PT-1'))),
+    ('ix_entity_package_id', False, dict(filters=dict(package=2))),
+    ('ix_entity_big_id', False, dict(filters=dict(big=3))),
+    ('ix_entity_big_id', False, dict(filters=dict(big=3), after=100, limit=50)),
+    ('ix_entity_big_package_id', False, dict(filters=dict(big=3, package=2))),
+    ('ix_entity_place_number_id', False, dict(filters=dict(place_number=10))),
+    ('ix_entity_input_doc_output_doc', True, dict(filters=dict(input_doc=5))),
+    ('ix_entity_output_doc', False, dict(filters=dict(output_doc=5))),
+    ('ix_entity_input_doc_output_doc', True, dict(filters=dict(input_doc=5), sort='weight', descending=True)),
+    ('ix_entity_input_doc_output_doc', True, dict(date_from=datetime(2019, 1, 2), date_to=datetime(2019, 1, 3))),
+    ('ix_entity_input_doc_output_doc', True, dict(sent_from=datetime(2019, 1, 2), sent_to=datetime(2019, 1, 3))),
+    ('ix_entity_name_id', False, dict(filters=dict(name='Труба 1'), date_from=datetime(2019, 1, 2))),
+)
+
+
+def explain(conn, query):
+    compiled = query.statement.compile(conn.engine)
+    params = [compiled.params[_] for _ in compiled.positiontup]
+    rows = conn.exec_driver_sql('EXPLAIN QUERY PLAN %s' % compiled, tuple(params)).fetchall()
+    return [_[-1] for _ in rows]
+
+
+def full_scan(plan):
+    # "SCAN entity" без USING - полный просмотр таблицы, в старых версиях SQLite "SCAN TABLE entity"
+    return [_ for _ in plan if _.startswith('SCAN') and 'USING' not in _]
+
+
+def entity_index(plan):
+    for _ in plan:
+        match = re.match(r'(?:SEARCH|SCAN) (?:TABLE )?entity USING (?:COVERING )?INDEX (\w+)', _)
+        if match:
+            return match.group(1)
+    return None
+
+
+def sorted_separately(plan):
+    return any(_.startswith('USE TEMP B-TREE') for _ in plan)
+
+
+def check(plan, index, sort):
+    """
+    :return: список расхождений плана с ожидаемым
+    """
+    errors = ['full scan: %s' % _ for _ in full_scan(plan)]
+    if entity_index(plan) != index:
+        errors.append('index %s, expected %s' % (entity_index(plan), index))
+    if sorted_separately(plan) != sort:
+        errors.append('separate sort step' if not sort else 'expected sort step is missing')
+    return errors
+
+
+def main():
+    configure(tempfile.mkdtemp(prefix='proton-bench-'))
+
+    from benchmarks.generate import generate
+    from database import get_engine, session, Entity
+
+    generate(200, 20)
+    with get_engine().begin() as conn:
+        conn.exec_driver_sql('ANALYZE')
+
+    results = []
+    failed = False
+    with get_engine().connect() as conn:
+        for index, sort, case in CASES:
+            case = dict(case)
+            limit = case.pop('limit', None)
+            query = Entity.search_query(**case)
+            if limit is not None:
+                query = query.limit(limit)
+            plan = explain(conn, query)
+            errors = check(plan, index, sort)
+            failed = failed or bool(errors)
+            results.append(dict(case={k: str(v) for k, v in case.items()}, plan=plan, errors=errors))
+    session.remove()
+
+    print(json.dumps(results, indent=2, ensure_ascii=False))
+    if failed:
+        print('Unexpected plans in entity search', file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
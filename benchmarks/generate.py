@@ -0,0 +1,124 @@
+"""
+Генератор синтетических данных склада.
+
+    python -m benchmarks.generate --docs 10000 --entities 200
+
+Без --config создает базу во временном каталоге, с --config наполняет базу из указанных настроек.
+Данные пишутся через модели database.py, генерация детерминирована при одинаковом --seed.
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+from datetime import datetime, timedelta
+
+from benchmarks import configure
+
+CONTRAGENTS = 50
+BIGS = 20
+PACKAGES = 10
+PLACES = 30
+PORTS = 8
+OBJECTS = 12
+ENTITY_CLASSES = 40
+DOC_TYPES = ("Приёмка", "Отгрузка", "Внутреннее перемещение")
+TRANSPORT_TYPES = ("Авто", "ЖД", "Морской")
+
+
+def add_references():
+    from database import session, Contragent, Big, Package, Place, Port, Object, DocType, TransportType, \
+        EntityClass
+
+    session.add_all([Contragent(name='Контрагент %s' % _) for _ in range(CONTRAGENTS)])
+    session.add_all([Big(name='Номенклатура %s' % _) for _ in range(BIGS)])
+    session.add_all([Package(name='Упаковка %s' % _) for _ in range(PACKAGES)])
+    session.add_all([Place(name='Место %s' % _) for _ in range(PLACES)])
+    session.add_all([Port(name='Порт %s' % _) for _ in range(PORTS)])
+    session.add_all([Object(id='OBJ-%s' % _) for _ in range(OBJECTS)])
+    session.add_all([DocType(name=_, processable=True) for _ in DOC_TYPES])
+    session.add_all([TransportType(name=_) for _ in TRANSPORT_TYPES])
+    session.add_all([EntityClass(name='Труба %s' % _) for _ in range(ENTITY_CLASSES)])
+    session.commit()
+
+
+def make_entities(rnd, count, serial):
+    from database import Entity
+
+    entities = []
+    for _ in range(count):
+        serial += 1
+        entities.append(Entity(
+            name='Труба %s' % rnd.randrange(ENTITY_CLASSES),
+            big=rnd.randint(1, BIGS),
+            pipe_tag='PT-%s' % rnd.randrange(100000),
+            inplace_count=str(rnd.randint(1, 10)),
+            package=rnd.randint(1, PACKAGES),
+            segment_number='SEG-%08d' % serial,
+            weight=round(rnd.uniform(0.5, 30.0), 3),
+            height=round(rnd.uniform(6.0, 12.0), 2),
+            diameter=round(rnd.uniform(0.1, 1.4), 3),
+            thickness=round(rnd.uniform(0.005, 0.03), 4),
+            place_number=rnd.randint(1, 500),
+            extra=None
+        ))
+    return entities, serial
+
+
+def generate(docs=1000, entities=50, seed=42):
+    """
+    :return: количество созданных документов и грузопозиций
+    """
+    from database import session, init_db, MovementDoc
+
+    init_db()
+    rnd = random.Random(seed)
+    add_references()
+    started = datetime(2019, 1, 1)
+    serial = 0
+    for number in range(docs):
+        send_date = started + timedelta(hours=number)
+        doc = MovementDoc(
+            tag='DOC-%06d' % number,
+            contract='C-%s' % rnd.randrange(200),
+            type=rnd.randint(1, len(DOC_TYPES)),
+            sender=rnd.randint(1, CONTRAGENTS),
+            receiver=rnd.randint(1, CONTRAGENTS),
+            transport_type=rnd.randint(1, len(TRANSPORT_TYPES)),
+            transport_tag='TR-%s' % rnd.randrange(1000),
+            send_date=send_date,
+            receive_date=send_date + timedelta(days=rnd.randint(0, 20)),
+            danger_class=str(rnd.randint(1, 9)),
+            port=rnd.randint(1, PORTS),
+            object='OBJ-%s' % rnd.randrange(OBJECTS),
+            place=rnd.randint(1, PLACES),
+            big=rnd.randint(1, BIGS),
+            extra=None
+        )
+        items, serial = make_entities(rnd, entities, serial)
+        doc.save_with_entities(items)
+        session.expunge_all()
+    return docs, serial
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Синтетические данные склада")
+    parser.add_argument('--docs', type=int, default=1000)
+    parser.add_argument('--entities', type=int, default=50, help="грузопозиций в документе")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--config', help="файл настроек с целевой базой")
+    args = parser.parse_args()
+
+    if not args.config:
+        print(configure(tempfile.mkdtemp(prefix='proton-bench-')), file=sys.stderr)
+    else:
+        os.environ['PROTON_CONFIG'] = args.config
+
+    started = time.monotonic()
+    docs, entities = generate(args.docs, args.entities, args.seed)
+    print("%s docs, %s entities in %.1fs" % (docs, entities, time.monotonic() - started), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""
+Время импорта модулей и создания приложения, отсутствие побочных эффектов при импорте.
+
+    python -m benchmarks.import_time --runs 5
+
+Каждый замер - отдельный процесс интерпретатора, чтобы не попадать в кэш sys.modules.
+Настройки указывают на несуществующий файл SQLite: после импорта database, app и importer
+и вызова create_app() файл базы не должен появиться.
+"""
+import os
+import sys
+import json
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+from benchmarks import configure
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CASES = (
+    ('import database', 'import database'),
+    ('import app', 'import app'),
+    ('import importer', 'import importer'),
+    ('create_app()', 'import app; app.create_app()'),
+)
+
+PROBE = """
+import sys, time
+sys.path.insert(0, %r)
+started = time.perf_counter()
+%s
+print(time.perf_counter() - started)
+"""
+
+
+def measure(statement):
+    output = subprocess.check_output([sys.executable, '-c', PROBE % (ROOT, statement)], cwd=ROOT)
+    return float(output.decode().strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Время импорта и создания приложения")
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='proton-bench-')
+    configure(workdir)
+    database = os.path.join(workdir, 'bench.db')
+
+    results = {}
+    for name, statement in CASES:
+        timings = [measure(statement) for _ in range(args.runs)]
+        results[name] = dict(median_ms=round(statistics.median(timings) * 1000, 1),
+                             max_ms=round(max(timings) * 1000, 1))
+    side_effects = os.path.exists(database)
+    print(json.dumps(dict(results=results, database_created=side_effects), indent=2, ensure_ascii=False))
+    if side_effects:
+        print("FAIL: import created %s" % database, file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+"""
+Задержка PUT /api/v1/doc для клиента: синхронная запись против фоновой загрузки (?async=1).
+
+    python -m benchmarks.ingest --sizes 10 100 1000 5000 --requests 10
+
+Для каждого размера документа замеряется время ответа синхронного PUT и PUT ?async=1
+(202 после проверки тела), а для фоновой загрузки еще и время до статуса done.
+"""
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+
+from benchmarks import configure
+
+SIZES = (10, 100, 1000, 5000)
+
+
+async def wait_done(app, job_id):
+    while True:
+        status, body = await call_body(app, 'GET', '/api/v1/job/%s' % job_id)
+        job = json.loads(body)
+        if job['status'] in ('done', 'failed'):
+            return job['status']
+        await asyncio.sleep(0.01)
+
+
+async def measure(app, sizes, requests, seed):
+    from benchmarks.run import doc_body, percentile
+
+    rnd = random.Random(seed)
+    serials = iter(range(1, 10 ** 9))
+    results = {}
+    await app.router.startup()
+    try:
+        for size in sizes:
+            sync, accepted, completed, failed = [], [], [], 0
+            for _ in range(requests):
+                body = json.dumps(doc_body(rnd, serials, size)).encode()
+                started = time.perf_counter()
+                status, _ = await call_body(app, 'PUT', '/api/v1/doc', '', body)
+                sync.append(time.perf_counter() - started)
+
+                body = json.dumps(doc_body(rnd, serials, size)).encode()
+                started = time.perf_counter()
+                status, response = await call_body(app, 'PUT', '/api/v1/doc', 'async=1', body)
+                accepted.append(time.perf_counter() - started)
+                state = await wait_done(app, json.loads(response)['id'])
+                completed.append(time.perf_counter() - started)
+                failed += state != 'done'
+            results[size] = dict(
+                sync_p50_ms=round(percentile(sync, 50) * 1000, 2),
+                async_accept_p50_ms=round(percentile(accepted, 50) * 1000, 2),
+                async_accept_p95_ms=round(percentile(accepted, 95) * 1000, 2),
+                async_done_p50_ms=round(percentile(completed, 50) * 1000, 2),
+                failed=failed
+            )
+            print('%-6s %s' % (size, results[size]), file=sys.stderr)
+    finally:
+        await app.router.shutdown()
+    return results
+
+
+async def call_body(app, method, path, query='', body=b''):
+    """
+    Как benchmarks.run.call, но возвращает тело ответа.
+    """
+    scope = dict(type='http', asgi=dict(version='3.0'), http_version='1.1', method=method, scheme='http',
+                 path=path, raw_path=path.encode(), root_path='', query_string=query.encode(),
+                 headers=[(b'host', b'bench'), (b'content-length', str(len(body)).encode())],
+                 client=('127.0.0.1', 50000), server=('bench', 80))
+    state = dict(status=None, body=b'', sent=False)
+    finished = asyncio.Event()
+
+    async def receive():
+        if not state['sent']:
+            state['sent'] = True
+            return dict(type='http.request', body=body, more_body=False)
+        await finished.wait()
+        return dict(type='http.disconnect')
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            state['status'] = message['status']
+        elif message['type'] == 'http.response.body':
+            state['body'] += message.get('body', b'')
+            if not message.get('more_body', False):
+                finished.set()
+
+    await app(scope, receive, send)
+    return state['status'], state['body']
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Задержка синхронной и фоновой загрузки документов")
+    parser.add_argument('--sizes', type=int, nargs='*', default=list(SIZES), help="грузопозиций в документе")
+    parser.add_argument('--requests', type=int, default=10, help="документов на размер")
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    configure(tempfile.mkdtemp(prefix='proton-bench-'))
+
+    from benchmarks.generate import add_references
+    from database import init_db
+
+    init_db()
+    add_references()
+
+    from app import app
+
+    results = asyncio.run(measure(app, args.sizes, args.requests, args.seed))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""
+Количество SQL-запросов на сериализацию документов движения.
+
+Запуск из корня репозитория:
+
+    python -m benchmarks.query_count
+
+Скрипт создает временную SQLite базу, наполняет ее документами с разным числом
+грузопозиций и проверяет, что число запросов не зависит от размера документа.
+"""
+import sys
+import json
+import tempfile
+
+from benchmarks import configure
+
+SIZES = (1, 10, 100, 400)
+PAGE = 20
+
+
+def main():
+    workdir = tempfile.mkdtemp(prefix='proton-bench-')
+    configure(workdir)
+
+    from sqlalchemy import event
+    from database import get_engine, init_db, session, MovementDoc, Entity, DocEntity, serialize_docs
+
+    counter = dict(queries=0)
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        counter['queries'] += 1
+
+    init_db()
+    event.listen(get_engine(), 'before_cursor_execute', count)
+
+    docs = []
+    for size in SIZES:
+        for _ in range(PAGE):
+            doc = MovementDoc(tag=str(size))
+            session.add(doc)
+            session.flush()
+            entities = [Entity(name='bench', big=None, weight=1.0, height=1.0, diameter=1.0, input_doc=doc.id)
+                        for _ in range(size)]
+            session.add_all(entities)
+            session.flush()
+            session.add_all([DocEntity(doc=doc.id, entity=_.id, position=position)
+                             for position, _ in enumerate(entities)])
+            docs.append(doc.id)
+    session.commit()
+
+    results = []
+    failed = False
+    for size in SIZES:
+        session.expunge_all()
+        page = session.query(MovementDoc).filter_by(tag=str(size)).all()
+
+        session.expunge_all()
+        counter['queries'] = 0
+        page[0].serialized
+        single = counter['queries']
+
+        session.expunge_all()
+        counter['queries'] = 0
+        serialize_docs(page)
+        batch = counter['queries']
+
+        results.append(dict(entities=size, single_doc_queries=single, page_queries=batch, page_size=len(page)))
+        failed = failed or single != 1 or batch != 1
+
+    print(json.dumps(results, indent=2))
+    if failed:
+        print('Query count depends on document size', file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,290 @@
+"""
+Нагрузочный прогон всех маршрутов app.py внутри процесса.
+
+    python -m benchmarks.run --docs 1000 --entities 50 --requests 500 --concurrency 16 --output bench.json
+
+Каждый прогон создает новую базу во временном каталоге и наполняет ее benchmarks.generate с
+фиксированным --seed, поэтому результаты разных коммитов сравнимы. Запросы выполняются напрямую
+через ASGI-интерфейс приложения параллельными клиентами в одном event loop. В результат пишутся
+пропускная способность, p50/p95/p99 задержки, ошибки и пиковый RSS процесса.
+"""
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+from datetime import datetime
+
+from benchmarks import configure
+
+PROPERTIES = ('big', 'contragent', 'object', 'place', 'port', 'type', 'package', 'transport')
+
+
+class Scenario(object):
+
+    def __init__(self, name, method, build):
+        self.name = name
+        self.method = method
+        self.build = build
+
+
+async def call(app, method, path, query='', body=b''):
+    """
+    Один HTTP-запрос через ASGI без сети.
+
+    :return: (статус, размер тела)
+    """
+    scope = dict(
+        type='http',
+        asgi=dict(version='3.0'),
+        http_version='1.1',
+        method=method,
+        scheme='http',
+        path=path,
+        raw_path=path.encode(),
+        root_path='',
+        query_string=query.encode(),
+        headers=[(b'host', b'bench'), (b'content-length', str(len(body)).encode())],
+        client=('127.0.0.1', 50000),
+        server=('bench', 80)
+    )
+    state = dict(status=None, size=0, sent=False)
+    finished = asyncio.Event()
+
+    async def receive():
+        if not state['sent']:
+            state['sent'] = True
+            return dict(type='http.request', body=body, more_body=False)
+        # Как и настоящий сервер, отключение клиента приходит только после полного ответа
+        await finished.wait()
+        return dict(type='http.disconnect')
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            state['status'] = message['status']
+        elif message['type'] == 'http.response.body':
+            state['size'] += len(message.get('body', b''))
+            if not message.get('more_body', False):
+                finished.set()
+
+    await app(scope, receive, send)
+    return state['status'], state['size']
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(q / 100.0 * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+def peak_rss_mb():
+    # ru_maxrss в килобайтах на Linux и в байтах на macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024.0 * 1024.0) if sys.platform == 'darwin' else rss / 1024.0
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def doc_body(rnd, serials, entities):
+    items = []
+    for _ in range(entities):
+        items.append(dict(
+            name='Труба %s' % rnd.randrange(40),
+            pipe_tag=None,
+            inplace_count='1',
+            weight=round(rnd.uniform(0.5, 30.0), 3),
+            length=round(rnd.uniform(6.0, 12.0), 2),
+            segment_number='BENCH-%s' % next(serials),
+            diameter=round(rnd.uniform(0.1, 1.4), 3),
+            thickness=0.01,
+            place_number=1,
+            extra=None
+        ))
+    return dict(type=1, port=1, sender=1, receiver=2, place=1, transport_type=1, object='OBJ-1',
+                danger_class='1', big=1, transport_tag='TR-1', tag='BENCH', send_date='2021-09-01',
+                receive_date='2021-09-02', extra=None, contract='C-1', entities=items)
+
+
+def scenarios(docs, entities, rnd):
+    serials = iter(range(1, 10 ** 9))
+    created = []
+
+    def random_doc():
+        return rnd.randint(1, docs)
+
+    def suggest():
+        # префикс номера сегмента из benchmarks.generate без двух последних цифр
+        return '/api/v1/entity/suggest', 'q=SEG-%06d' % rnd.randrange(docs * entities // 100 + 1), b''
+
+    def put():
+        return '/api/v1/doc', '', json.dumps(doc_body(rnd, serials, 20)).encode()
+
+    def put_async():
+        return '/api/v1/doc', 'async=1', json.dumps(doc_body(rnd, serials, 20)).encode()
+
+    def patch():
+        doc_id = rnd.choice(created) if created else random_doc()
+        return '/api/v1/doc/%s' % doc_id, '', None
+
+    def delete():
+        doc_id = created.pop() if created else docs + 10 ** 6
+        return '/api/v1/doc/%s' % doc_id, '', b''
+
+    return created, [
+        Scenario('ping', 'GET', lambda: ('/api/v1/ping', '', b'')),
+        Scenario('metrics', 'GET', lambda: ('/metrics', '', b'')),
+        Scenario('properties', 'GET', lambda: ('/api/v1/properties/%s' % rnd.choice(PROPERTIES), '', b'')),
+        Scenario('entity', 'GET', lambda: ('/api/v1/entity/%s' % rnd.randint(1, docs * entities), '', b'')),
+        Scenario('entity_search', 'GET', lambda: ('/api/v1/entity', 'big=%s&limit=50' % rnd.randint(1, 20), b'')),
+        Scenario('entity_suggest', 'GET', suggest),
+        Scenario('stock', 'GET', lambda: ('/api/v1/stock', '', b'')),
+        Scenario('export', 'GET', lambda: ('/api/v1/export', 'date_from=2019-01-0%s' % rnd.randint(1, 9), b'')),
+        Scenario('doc', 'GET', lambda: ('/api/v1/doc/%s' % random_doc(), '', b'')),
+        Scenario('doc_page', 'GET', lambda: ('/api/v1/doc', 'after=%s&limit=50' % random_doc(), b'')),
+        Scenario('doc_stream', 'GET', lambda: ('/api/v1/doc', 'format=ndjson&after=%s&limit=200' % random_doc(), b'')),
+        Scenario('doc_put', 'PUT', put),
+        Scenario('doc_put_async', 'PUT', put_async),
+        Scenario('doc_patch', 'PATCH', patch),
+        Scenario('doc_delete', 'DELETE', delete),
+    ]
+
+
+async def run_scenario(app, scenario, requests, concurrency, bodies):
+    latencies = []
+    errors = []
+    remaining = [requests]
+
+    async def client():
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            path, query, body = scenario.build()
+            if body is None:
+                body = bodies.get(path, b'{}')
+            started = time.perf_counter()
+            status, size = await call(app, scenario.method, path, query, body)
+            latencies.append(time.perf_counter() - started)
+            if status >= 400:
+                errors.append(status)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - started
+    return dict(
+        requests=len(latencies),
+        errors=len(errors),
+        seconds=round(elapsed, 3),
+        throughput=round(len(latencies) / elapsed, 1) if elapsed else None,
+        p50_ms=round(percentile(latencies, 50) * 1000, 2),
+        p95_ms=round(percentile(latencies, 95) * 1000, 2),
+        p99_ms=round(percentile(latencies, 99) * 1000, 2),
+        peak_rss_mb=round(peak_rss_mb(), 1)
+    )
+
+
+async def run(app, docs, entities, requests, concurrency, seed, only=None):
+    rnd = random.Random(seed)
+    created, plan = scenarios(docs, entities, rnd)
+    await app.router.startup()
+    bodies = {}
+    results = {}
+    try:
+        for scenario in plan:
+            if only and scenario.name not in only:
+                continue
+            if scenario.name in ('doc_patch', 'doc_delete'):
+                # PATCH и DELETE работают только с документами, созданными на шаге doc_put
+                created[:] = patch_bodies(bodies)
+            results[scenario.name] = await run_scenario(app, scenario, requests, concurrency, bodies)
+            print('%-12s %s' % (scenario.name, results[scenario.name]), file=sys.stderr)
+    finally:
+        await app.router.shutdown()
+    return results
+
+
+def patch_bodies(bodies):
+    """
+    Тела PATCH для документов doc_put: те же поля, у грузопозиций изменен вес.
+
+    :return: id документов
+    """
+    from database import session, MovementDoc
+
+    try:
+        docs = session.query(MovementDoc).filter_by(tag='BENCH').order_by(MovementDoc.id).all()
+        for doc in docs:
+            item = doc.serialized
+            item['send_date'] = item['send_date'].strftime('%Y-%m-%d')
+            item['receive_date'] = item['receive_date'].strftime('%Y-%m-%d')
+            item['entities'] = [dict(
+                id=_['id'],
+                name=_['name'],
+                inplace_count=_['inplace_count'],
+                pipe_tag=_['package'],
+                weight=(_['weight'] or 0) + 1,
+                length=_['height'],
+                segment_number=_['segment_number'],
+                diameter=_['diameter'],
+                thickness=_['thickness'],
+                place_number=_['place_number'],
+                extra=_['extra']
+            ) for _ in item['entities']]
+            bodies['/api/v1/doc/%s' % doc.id] = json.dumps(item, default=str).encode()
+        return [_.id for _ in docs]
+    finally:
+        session.remove()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон маршрутов Proton Backend")
+    parser.add_argument('--docs', type=int, default=1000)
+    parser.add_argument('--entities', type=int, default=50, help="грузопозиций в документе")
+    parser.add_argument('--requests', type=int, default=500, help="запросов на сценарий")
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--only', nargs='*', help="запустить только указанные сценарии")
+    parser.add_argument('--output', default='bench.json')
+    args = parser.parse_args()
+
+    configure(tempfile.mkdtemp(prefix='proton-bench-'))
+
+    from benchmarks.generate import generate
+
+    started = time.monotonic()
+    generate(args.docs, args.entities, args.seed)
+    generated = time.monotonic() - started
+
+    from app import app
+
+    results = asyncio.run(run(app, args.docs, args.entities, args.requests, args.concurrency, args.seed, args.only))
+    report = dict(
+        commit=git_commit(),
+        date=datetime.now().isoformat(timespec='seconds'),
+        python=platform.python_version(),
+        platform=platform.platform(),
+        docs=args.docs,
+        entities_per_doc=args.entities,
+        requests=args.requests,
+        concurrency=args.concurrency,
+        seed=args.seed,
+        generate_seconds=round(generated, 1),
+        scenarios=results
+    )
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2, ensure_ascii=False)
+    print('Results written to %s' % args.output, file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
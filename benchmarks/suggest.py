@@ -0,0 +1,80 @@
+"""
+Задержка подсказок по идентификаторам грузопозиций.
+
+    python -m benchmarks.suggest --docs 5000 --entities 200
+
+Наполняет временную базу (по умолчанию миллион грузопозиций), выполняет случайные префиксы
+номеров сегментов, меток труб и классов через Entity.suggest и печатает p50/p95/p99.
+Завершается с кодом 1, если p95 больше --budget-ms.
+"""
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+
+from benchmarks import configure
+from benchmarks.run import percentile
+
+
+def queries(rnd, entities, count):
+    result = []
+    for _ in range(count):
+        kind = rnd.randrange(3)
+        if kind == 0:
+            value = 'SEG-%08d' % rnd.randint(1, entities)
+            result.append(value[:rnd.randint(6, len(value))])
+        elif kind == 1:
+            value = 'PT-%s' % rnd.randrange(100000)
+            result.append(value[:rnd.randint(5, len(value))])
+        else:
+            result.append('Труба %s' % rnd.randrange(40))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Задержка подсказок по грузопозициям")
+    parser.add_argument('--docs', type=int, default=5000)
+    parser.add_argument('--entities', type=int, default=200, help="грузопозиций в документе")
+    parser.add_argument('--queries', type=int, default=2000)
+    parser.add_argument('--limit', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--budget-ms', type=float, default=10.0)
+    args = parser.parse_args()
+
+    configure(tempfile.mkdtemp(prefix='proton-bench-'))
+
+    from benchmarks.generate import generate
+    from database import session, Entity
+
+    started = time.monotonic()
+    docs, entities = generate(args.docs, args.entities, args.seed)
+    generated = time.monotonic() - started
+
+    rnd = random.Random(args.seed)
+    latencies = []
+    found = 0
+    for value in queries(rnd, entities, args.queries):
+        query_started = time.perf_counter()
+        found += bool(Entity.suggest(value, args.limit))
+        latencies.append(time.perf_counter() - query_started)
+    session.remove()
+
+    report = dict(
+        entities=entities,
+        generate_seconds=round(generated, 1),
+        queries=len(latencies),
+        with_results=found,
+        p50_ms=round(percentile(latencies, 50) * 1000, 2),
+        p95_ms=round(percentile(latencies, 95) * 1000, 2),
+        p99_ms=round(percentile(latencies, 99) * 1000, 2)
+    )
+    print(json.dumps(report, indent=2))
+    if report['p95_ms'] > args.budget_ms:
+        print('p95 %.2f ms is over budget %.2f ms' % (report['p95_ms'], args.budget_ms), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+import json
+import time
+import hashlib
+import threading
+
+import logging
+from logs import get_logger
+
+LOGGER = get_logger()
+
+
+class ReferenceCache(object):
+    """
+    Кэш справочников в памяти процесса.
+
+    Хранит уже закодированный JSON, поэтому попадание в кэш не требует ни запроса к БД,
+    ни сериализации. Запись сбрасывается при сохранении/удалении элемента справочника
+    и, если задан ttl, по истечении времени (изменения из других процессов, например импортера).
+    """
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self.loaders = {}
+        self.tables = {}
+        self.entries = {}
+        self.generations = {}
+        self.lock = threading.Lock()
+
+    def register(self, key, table, loader):
+        self.loaders[key] = loader
+        self.tables.setdefault(table, set()).add(key)
+        self.generations.setdefault(key, 0)
+
+    def peek(self, key):
+        """
+        :return: (данные, etag) или None, если записи нет или она устарела
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        data, etag, loaded = entry
+        if self.ttl and time.monotonic() - loaded > self.ttl:
+            return None
+        return data, etag
+
+    def get(self, key):
+        entry = self.peek(key)
+        if entry is not None:
+            return entry
+        with self.lock:
+            entry = self.peek(key)
+            if entry is not None:
+                return entry
+            generation = self.generations[key]
+            data = json.dumps(self.loaders[key](), ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+            etag = '"%s-%s"' % (key, hashlib.sha1(data).hexdigest()[:16])
+            if self.generations[key] == generation:
+                self.entries[key] = (data, etag, time.monotonic())
+            return data, etag
+
+    def keys(self, table):
+        return sorted(self.tables.get(table, ()))
+
+    def invalidate(self, table):
+        for key in self.tables.get(table, ()):
+            self.generations[key] += 1
+            self.entries.pop(key, None)
+            LOGGER.log(logging.DEBUG, msg="Reference cache %s invalidated" % key)
+
+    def warm(self):
+        for key in self.loaders:
+            self.get(key)
+
+
+reference_cache = ReferenceCache()
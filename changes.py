@@ -0,0 +1,206 @@
+"""
+Лента изменений для терминалов: GET /api/v1/changes (server-sent events) вместо опроса
+/api/v1/doc и /api/v1/properties/* по таймеру.
+
+Модели публикуют событие после commit из потоков пула, брокер раздает его подписчикам в потоке
+event loop. У каждого клиента своя ограниченная очередь: клиент, который не успевает читать,
+получает reset и перечитывает данные, а не копит события в памяти процесса. Неактивный клиент -
+это одна ожидающая задача без запросов к БД.
+
+Брокер у каждого процесса свой. Записи из других процессов (воркеры uvicorn, importer.py) видны
+через счетчики ревизий документов и справочников: они читаются одним запросом раз в poll секунд.
+"""
+import uuid
+import asyncio
+from collections import deque
+
+from starlette.concurrency import run_in_threadpool
+
+import logging
+from logs import get_logger
+
+from metrics import CHANGES_SUBSCRIBERS, CHANGES_RESETS
+from responses import dumps
+
+LOGGER = get_logger()
+
+CHANGES_BUFFER = 64
+CHANGES_HISTORY = 256
+CHANGES_HEARTBEAT = 15.0
+CHANGES_POLL = 5.0
+CHANGES_MAX_CLIENTS = 1000
+CHANGES_RETRY_MS = 3000
+
+
+class Subscriber(object):
+
+    def __init__(self, size):
+        self.queue = asyncio.Queue(maxsize=size)
+        self.lost = False
+
+
+class ChangeBroker(object):
+    """
+    Раздача событий изменений подписчикам процесса.
+
+    :param buffer: событий в очереди клиента, при переполнении клиент получает reset
+    :param history: последних событий для досылки по Last-Event-ID после переподключения
+    """
+
+    def __init__(self, buffer=CHANGES_BUFFER, history=CHANGES_HISTORY):
+        self.buffer = buffer
+        self.history = deque(maxlen=history)
+        self.subscribers = set()
+        self.sequence = 0
+        # id событий "<epoch>-<номер>": Last-Event-ID от другого процесса или до перезапуска не совпадет
+        self.epoch = uuid.uuid4().hex[:8]
+        # Последние известные значения счетчиков ревизий, None - до первого чтения
+        self.revisions = None
+        self.loop = None
+        self.watcher = None
+
+    def start(self, load_revisions, on_change=None, poll=CHANGES_POLL, buffer=CHANGES_BUFFER):
+        """
+        :param load_revisions: функция без аргументов, {счетчик: значение} (вызывается в потоке пула)
+        :param on_change: функция имени счетчика, который изменил другой процесс: сбрасывает кэши
+            и возвращает имена событий, по умолчанию событие с именем счетчика
+        """
+        self.loop = asyncio.get_event_loop()
+        self.buffer = buffer
+        if poll:
+            self.watcher = asyncio.ensure_future(self.watch(load_revisions, on_change, poll))
+
+    async def stop(self):
+        self.loop = None
+        self.revisions = None
+        if self.watcher is not None:
+            self.watcher.cancel()
+            await asyncio.gather(self.watcher, return_exceptions=True)
+            self.watcher = None
+
+    def publish(self, table, op, ids=None, revision=None, counter=None):
+        """
+        Событие после commit. Вызывается из любого потока, до start() и вне приложения
+        (скрипты, импорт) ничего не делает.
+
+        :param revision: значение счетчика ревизий counter после commit
+        """
+        loop = self.loop
+        if loop is None:
+            return
+        event = dict(table=table, op=op)
+        if ids is not None:
+            event['ids'] = list(ids)
+        if revision is not None:
+            event['revision'] = revision
+        try:
+            loop.call_soon_threadsafe(self.dispatch, event, counter)
+        except RuntimeError:
+            # event loop уже закрыт: приложение останавливается
+            pass
+
+    def dispatch(self, event, counter=None):
+        """
+        Раздача события подписчикам, только в потоке event loop.
+
+        :param counter: счетчик ревизий, который изменила запись: watch не повторит ее событием change
+        """
+        self.sequence += 1
+        revision = event.get('revision')
+        if counter is not None and revision is not None and self.revisions is not None:
+            self.revisions[counter] = max(self.revisions.get(counter, 0), revision)
+        item = (self.sequence, event['table'], dumps(event))
+        self.history.append(item)
+        for subscriber in self.subscribers:
+            if subscriber.lost:
+                continue
+            try:
+                subscriber.queue.put_nowait(item)
+            except asyncio.QueueFull:
+                subscriber.lost = True
+
+    async def watch(self, load_revisions, on_change, poll):
+        # Счетчики читаются и без подписчиков: по ним on_change сбрасывает кэши процесса
+        while True:
+            try:
+                revisions = await run_in_threadpool(load_revisions)
+            except Exception as e:
+                LOGGER.log(logging.WARNING, msg="Changes watcher: %s" % (e.args,))
+            else:
+                self.compare(revisions, on_change)
+            await asyncio.sleep(poll)
+
+    def compare(self, revisions, on_change=None):
+        """
+        Событие change на каждый счетчик, выросший с прошлого чтения без событий этого процесса.
+        """
+        if self.revisions is None:
+            self.revisions = dict(revisions)
+            return
+        for counter, revision in revisions.items():
+            if revision <= self.revisions.get(counter, 0):
+                continue
+            self.revisions[counter] = revision
+            for table in (on_change(counter) if on_change else [counter]):
+                self.dispatch(dict(table=table, op='change', revision=revision))
+
+    def event_id(self, sequence):
+        return ('%s-%d' % (self.epoch, sequence)).encode()
+
+    def subscribe(self, last_event_id=None):
+        """
+        :param last_event_id: заголовок Last-Event-ID, пропущенные после него события досылаются из истории
+        """
+        subscriber = Subscriber(self.buffer)
+        if last_event_id:
+            epoch, _, last_id = last_event_id.partition('-')
+            last_id = int(last_id) if last_id.isdigit() else -1
+            first = self.history[0][0] if self.history else self.sequence + 1
+            if epoch != self.epoch or last_id > self.sequence or last_id < first - 1:
+                # Пропущенных событий уже нет в истории, или id выдан другим процессом
+                subscriber.lost = True
+            else:
+                for item in self.history:
+                    if item[0] <= last_id:
+                        continue
+                    try:
+                        subscriber.queue.put_nowait(item)
+                    except asyncio.QueueFull:
+                        subscriber.lost = True
+                        break
+        self.subscribers.add(subscriber)
+        CHANGES_SUBSCRIBERS.set(len(self.subscribers))
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        self.subscribers.discard(subscriber)
+        CHANGES_SUBSCRIBERS.set(len(self.subscribers))
+
+    async def stream(self, last_event_id=None, heartbeat=CHANGES_HEARTBEAT):
+        """
+        Тело ответа text/event-stream. Подписка создается при первой итерации и снимается при
+        отключении клиента.
+        """
+        subscriber = self.subscribe(last_event_id)
+        try:
+            yield b'retry: %d\n\n' % CHANGES_RETRY_MS
+            while True:
+                if subscriber.lost:
+                    while not subscriber.queue.empty():
+                        subscriber.queue.get_nowait()
+                    subscriber.lost = False
+                    CHANGES_RESETS.inc()
+                    yield b'id: %s\nevent: reset\ndata: {}\n\n' % self.event_id(self.sequence)
+                    continue
+                try:
+                    sequence, table, data = await asyncio.wait_for(subscriber.queue.get(), heartbeat)
+                except asyncio.TimeoutError:
+                    # Комментарий держит соединение открытым через прокси
+                    yield b': ping\n\n'
+                    continue
+                yield b'id: %s\nevent: %s\ndata: %s\n\n' % (self.event_id(sequence), table.encode(), data)
+        finally:
+            self.unsubscribe(subscriber)
+
+
+change_broker = ChangeBroker()
@@ -1,40 +1,301 @@
-from sqlalchemy import create_engine, Boolean, ForeignKey, Column, String, Float, DateTime, \
-    Integer, LargeBinary, UniqueConstraint, BigInteger, ForeignKeyConstraint, inspect
+from sqlalchemy import create_engine, event, Boolean, ForeignKey, Column, String, Float, DateTime, \
+    Integer, LargeBinary, UniqueConstraint, BigInteger, ForeignKeyConstraint, Index, Sequence, inspect, select, text, \
+    func, and_, or_, literal_column
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.engine.url import URL
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import sessionmaker, scoped_session, relationship
+from sqlalchemy.pool import QueuePool
 
-import json
+import re
+import uuid
+import threading
+from datetime import datetime
+from contextvars import ContextVar
+from contextlib import contextmanager
 
 import random
 
 from settings import Settings
+from cache import reference_cache
+from changes import change_broker
 
 import logging
 from logs import get_logger
 
 LOGGER = get_logger()
 
-config = Settings()
-
-if config.get('database', 'engine'):
-    DATABASE = {
-        'drivername': config.get('database', 'engine'),
-        'host': config.get('database', 'host'),
-        'database': config.get('database', 'name'),
-        'username': config.get('database', 'login'),
-        'password': config.get('database', 'password')
-    }
-else:
-    DATABASE = {
-        'drivername': 'sqlite',
-        'database': './data.db'
-    }
-
 Model = declarative_base()
-dbengine = create_engine(URL(**DATABASE))
-Session = sessionmaker(bind=dbengine)
-session = Session()
+Session = sessionmaker()
+
+_config = None
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_config():
+    """
+    Настройки читаются при первом обращении, а не при импорте модуля.
+    """
+    global _config
+    if _config is None:
+        _config = Settings()
+    return _config
+
+
+def database_url(config):
+    if config.get('database', 'engine'):
+        return URL(
+            drivername=config.get('database', 'engine'),
+            host=config.get('database', 'host'),
+            database=config.get('database', 'name'),
+            username=config.get('database', 'login'),
+            password=config.get('database', 'password')
+        )
+    return URL(drivername='sqlite', database='./data.db')
+
+
+def pool_args(config):
+    return dict(
+        pool_size=config.get_int('database', 'pool_size', 5),
+        max_overflow=config.get_int('database', 'max_overflow', 10),
+        pool_timeout=config.get_float('database', 'pool_timeout', 30),
+        pool_recycle=config.get_int('database', 'pool_recycle', -1),
+        pool_pre_ping=config.get_bool('database', 'pool_pre_ping', False)
+    )
+
+
+def engine_args(url, config):
+    if not url.drivername.startswith('sqlite'):
+        return pool_args(config)
+    # Сессия запроса может выполняться в разных потоках пула, но не одновременно.
+    args = dict(connect_args={'check_same_thread': False})
+    if url.database in (None, '', ':memory:'):
+        # Для базы в памяти SQLAlchemy держит одно соединение на поток, параметры пула неприменимы.
+        return args
+    # По умолчанию файловая SQLite работает без пула и открывает файл на каждый checkout,
+    # тогда прагмы и страничный кэш соединения теряются после каждого запроса.
+    args.update(pool_args(config), poolclass=QueuePool)
+    return args
+
+
+def sqlite_pragmas(config):
+    return (
+        ('journal_mode', config.get('database', 'journal_mode') or 'WAL'),
+        ('synchronous', config.get('database', 'synchronous') or 'NORMAL'),
+        ('mmap_size', config.get_int('database', 'mmap_size', 268435456)),
+        ('cache_size', config.get_int('database', 'cache_size', -65536)),
+        ('busy_timeout', config.get_int('database', 'busy_timeout', 5000))
+    )
+
+
+def create_db_engine(config=None):
+    """
+    Движок БД по секции [database] настроек. Соединения открываются только при первом запросе.
+    """
+    config = config or get_config()
+    url = database_url(config)
+    engine = create_engine(url, **engine_args(url, config))
+    if url.drivername.startswith('sqlite'):
+        pragmas = sqlite_pragmas(config)
+
+        def set_sqlite_pragmas(dbapi_connection, connection_record):
+            """
+            Прагмы SQLite на каждое новое соединение: WAL позволяет читать во время записи,
+            busy_timeout заставляет писателя ждать блокировку вместо ошибки "database is locked".
+            """
+            cursor = dbapi_connection.cursor()
+            try:
+                for name, value in pragmas:
+                    cursor.execute('PRAGMA %s = %s' % (name, value))
+            finally:
+                cursor.close()
+
+        event.listen(engine, 'connect', set_sqlite_pragmas)
+    return engine
+
+
+def get_engine():
+    """
+    Общий движок процесса, создается при первом обращении.
+    """
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = create_db_engine()
+    return _engine
+
+
+def init_db(engine=None):
+    """
+    Создание недостающих таблиц. Вызывается явно (python migrations.py), а не при импорте.
+    """
+    Model.metadata.create_all(engine or get_engine())
+
+
+DOCS_REVISION = 'movement_doc'
+# Ревизии строк в Postgres, см. Revision.bump
+REVISION_SEQUENCE = Sequence('revision_seq', metadata=Model.metadata)
+
+ENTITY_FILTERS = dict(
+    name=str,
+    segment_number=str,
+    pipe_tag=str,
+    package=int,
+    big=int,
+    place_number=int,
+    input_doc=int,
+    output_doc=int
+)
+ENTITY_SORT = ('id', 'name', 'segment_number', 'pipe_tag', 'package', 'big', 'weight', 'place_number', 'input_doc')
+STOCK_GROUPS = ('big', 'entity_class', 'place')
+# INSERT ... ON CONFLICT для приращений сводки остатков, в остальных СУБД - UPDATE и INSERT
+STOCK_UPSERT = dict(postgresql=postgresql.insert, sqlite=sqlite.insert)
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+
+# Подсказки по идентификаторам грузопозиций: FTS5 в SQLite, триграммы pg_trgm в Postgres.
+# Индекс обновляется триггерами, поэтому пакетные вставки импорта и удаления пачкой тоже учитываются.
+SUGGEST_MIN_LENGTH = 2
+SUGGEST_EXPRESSION = "(coalesce(segment_number, '') || ' ' || coalesce(pipe_tag, '') || ' ' || " \
+                     "coalesce(name, '') || ' ' || coalesce(extra, ''))"
+
+# Префиксные индексы на 1-6 символов: без них префикс частого слова ("труба", "PT-1") собирает
+# полный список строк этого слова, и подсказка на миллионе грузопозиций занимает десятки миллисекунд.
+ENTITY_SEARCH_SQLITE = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS entity_fts USING fts5("
+    "segment_number, pipe_tag, name, extra, content='entity', content_rowid='id', prefix='1 2 3 4 5 6')",
+    "CREATE TRIGGER IF NOT EXISTS entity_fts_insert AFTER INSERT ON entity BEGIN "
+    "INSERT INTO entity_fts(rowid, segment_number, pipe_tag, name, extra) "
+    "VALUES (new.id, new.segment_number, new.pipe_tag, new.name, new.extra); END",
+    "CREATE TRIGGER IF NOT EXISTS entity_fts_delete AFTER DELETE ON entity BEGIN "
+    "INSERT INTO entity_fts(entity_fts, rowid, segment_number, pipe_tag, name, extra) "
+    "VALUES ('delete', old.id, old.segment_number, old.pipe_tag, old.name, old.extra); END",
+    "CREATE TRIGGER IF NOT EXISTS entity_fts_update AFTER UPDATE OF segment_number, pipe_tag, name, extra "
+    "ON entity BEGIN "
+    "INSERT INTO entity_fts(entity_fts, rowid, segment_number, pipe_tag, name, extra) "
+    "VALUES ('delete', old.id, old.segment_number, old.pipe_tag, old.name, old.extra); "
+    "INSERT INTO entity_fts(rowid, segment_number, pipe_tag, name, extra) "
+    "VALUES (new.id, new.segment_number, new.pipe_tag, new.name, new.extra); END",
+)
+
+ENTITY_SEARCH_POSTGRES = (
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS ix_entity_suggest_trgm ON entity USING gin (%s gin_trgm_ops)" % SUGGEST_EXPRESSION,
+)
+
+request_scope = ContextVar('request_scope', default=None)
+
+
+def current_scope():
+    scope = request_scope.get()
+    if scope is None:
+        return threading.get_ident()
+    return scope
+
+
+def create_session():
+    return Session(bind=get_engine())
+
+
+session = scoped_session(create_session, scopefunc=current_scope)
+
+
+async def get_session():
+    """
+    Зависимость FastAPI: сессия БД текущего запроса.
+
+    Сессия привязана к request_scope, который открывает SessionScopeMiddleware: обработчик, потоки
+    пула и фоновые задачи запроса работают с одной сессией, параллельные запросы - с разными.
+    Без области запроса сессия привязалась бы к потоку пула и пережила бы запрос.
+    """
+    if request_scope.get() is None:
+        raise RuntimeError("No request scope: SessionScopeMiddleware is not installed")
+    return session()
+
+
+@contextmanager
+def session_scope():
+    """
+    Отдельная сессия вне HTTP-запроса (старт приложения, скрипты, фоновые задачи в своем потоке),
+    закрывается на выходе из блока.
+    """
+    token = request_scope.set(object())
+    try:
+        yield session
+    finally:
+        session.remove()
+        request_scope.reset(token)
+
+
+def notify(table, op, ids=None, revision=None):
+    """
+    Событие ленты изменений (changes.py): публикуется после commit текущей транзакции,
+    при rollback отбрасывается.
+
+    :param revision: имя счетчика Revision, который меняет транзакция, в событие попадает его значение после commit
+    """
+    session.info.setdefault('changes', []).append((table, op, ids, revision))
+
+
+def commit_revisions(db_session):
+    """
+    Счетчики, которые Revision.bump отложил до commit (Postgres): строка счетчика блокируется
+    только на время commit, а не всей транзакции.
+    """
+    revisions = db_session.info.get('revisions')
+    for name, value in (revisions or {}).items():
+        if value is None:
+            revisions[name] = Revision.advance(db_session, name)
+
+
+def publish_changes(db_session):
+    revisions = db_session.info.pop('revisions', None) or {}
+    for table, op, ids, counter in db_session.info.pop('changes', ()):
+        change_broker.publish(table, op, ids, revisions.get(counter), counter)
+
+
+def discard_changes(db_session):
+    db_session.info.pop('changes', None)
+    db_session.info.pop('revisions', None)
+
+
+event.listen(Session, 'before_commit', commit_revisions)
+event.listen(Session, 'after_commit', publish_changes)
+event.listen(Session, 'after_rollback', discard_changes)
+
+
+@contextmanager
+def transaction(invalidate=None, reraise=False):
+    """
+    Транзакция в сессии текущей области: commit при выходе из блока, rollback и запись в лог при ошибке.
+
+    :param invalidate: таблица справочника, кэш которой сбрасывается после commit. Другие процессы
+        видят изменение по счетчику ревизий с именем таблицы, клиенты ленты изменений - по событию
+        с ключом справочника в /api/v1/properties
+    :param reraise: пробросить исключение после rollback, иначе ошибка только пишется в лог
+    """
+    try:
+        yield session
+        if invalidate is not None:
+            Revision.bump(invalidate)
+            for _ in reference_cache.keys(invalidate):
+                notify(_, 'change', None, invalidate)
+        session.commit()
+    except Exception as e:
+        LOGGER.log(level=logging.ERROR, msg="Database error: %s " % e.args)
+        LOGGER.log(level=logging.ERROR, msg="Rollback transaction.")
+        session.rollback()
+        if reraise:
+            raise
+        return
+    if invalidate is not None:
+        reference_cache.invalidate(invalidate)
 
 
 def serialize_collection(c_list):
@@ -44,6 +305,35 @@ def serialize_collection(c_list):
     return data
 
 
+def changed_fields(obj, values):
+    """
+    Только те значения, которые отличаются от сохраненных в объекте.
+    """
+    return {key: value for key, value in values.items() if getattr(obj, key) != value}
+
+
+def serialize_docs(docs):
+    """
+    Сериализация пачки документов движения вместе с грузопозициями.
+
+    Все грузопозиции страницы загружаются одним запросом по индексу movement_doc_entity,
+    порядок внутри документа задается колонкой position.
+    """
+    docs = list(docs)
+    entities = {_.id: [] for _ in docs}
+    if entities:
+        rows = session.query(DocEntity.doc, Entity).join(Entity, Entity.id == DocEntity.entity) \
+            .filter(DocEntity.doc.in_(list(entities))).order_by(DocEntity.doc, DocEntity.position)
+        for doc_id, entity in rows:
+            entities[doc_id].append(entity.serialized)
+    data = []
+    for doc in docs:
+        item = doc.header
+        item["entities"] = entities[doc.id]
+        data.append(item)
+    return data
+
+
 class Serializer(object):
 
     def serialize(self):
@@ -75,22 +365,9 @@ class Contragent(Model):
         return data
 
     def save(self, modify=False):
-        if not modify:
-            try:
+        with transaction(invalidate=self.__tablename__):
+            if not modify:
                 session.add(self)
-                session.commit()
-            except Exception as e:
-                LOGGER.log(level=logging.ERROR, msg="Database error: %s " % e.args)
-                LOGGER.log(level=logging.ERROR, msg="Rollback transaction.")
-                session.rollback()
-        else:
-            try:
-                session.flush()
-                session.commit()
-            except Exception as e:
-                LOGGER.log(level=logging.ERROR, msg="Database error: %s " % e.args)
-                LOGGER.log(level=logging.ERROR, msg="Rollback transaction.")
-                session.rollback()
 
 
 class Contract(Model):
@@ -104,22 +381,9 @@ class Contract(Model):
         return data
 
     def save(self, modify=False):
-        if not modify:
-            try:
+        with transaction():
+            if not modify:
                 session.add(self)
-                session.commit()
-            except Exception as e:
-                LOGGER.log(level=logging.ERROR, msg="Database error: %s " % e.args)
-                LOGGER.log(level=logging.ERROR, msg="Rollback transaction.")
-                session.rollback()
-        else:
-            try:
-                session.flush()
-                session.commit()
-            except Exception as e:
-                LOGGER.log(level=logging.ERROR, msg="Database error: %s " % e.args)
-                LOGGER.log(level=logging.ERROR, msg="Rollback transaction.")
-                session.rollback()
 
 
 class EntityClass(Model):
@@ -137,28 +401,23 @@ class EntityClass(Model):
         data = session.query(EntityClass).all()
         return data
 
+    @staticmethod
+    def ensure(names):
+        names = set(names)
+        existing = session.query(EntityClass.name).filter(EntityClass.name.in_(names)).all()
+        missing = names - {_.name for _ in existing}
+        if missing:
+            session.bulk_insert_mappings(EntityClass, [dict(name=_) for _ in missing])
+
     @property
     def serialized(self):
         data = Serializer.serialize(self)
         return data
 
     def save(self, modify=False):
-        if not modify:
-            try:
+        with transaction():
+            if not modify:
                 session.add(self)
-                session.commit()
-            except Exception as e:
-                LOGGER.log(level=logging.ERROR, msg="Database error: %s " % e.args)
-                LOGGER.log(level=logging.ERROR, msg="Rollback transaction.")
-                session.rollback()
-        else:
-            try:
-                session.flush()
-                session.commit()
-            except Exception as e:
-                LOGGER.log(level=logging.ERROR, msg="Database error: %s " % e.args)
-                LOGGER.log(level=logging.ERROR, msg="Rollback transaction.")
-                session.rollback()
 
 
 class TransportType(Model):
@@ -183,22 +442,9 @@ class TransportType(Model):
         return data
 
     def save(self, modify=False):
-        if not modify:
-            try:
+        with transaction(invalidate=self.__tablename__):
+            if not modify:
                 session.add(self)
-                session.commit()
-            except Exception as e:
-                LOGGER.log(level=logging.ERROR, msg="Database error: %s " % e.args)
-                LOGGER.log(level=logging.ERROR, msg="Rollback transaction.")
-                session.rollback()
-        else:
-            try:
-                session.flush()
-                session.commit()
-            except Exception as e:
-                LOGGER.log(level=logging.ERROR, msg="Database error: %s " % e.args)
-                LOGGER.log(level=logging.ERROR, msg="Rollback transaction.")
-                session.rollback()
 
 
 class Transport(Model):
@@ -223,23 +469,12 @@ class Transport(Model):
         return data
 
     def save(self):
-        try:
+        with transaction():
             session.add(self)
-            session.commit()
-        except Exception as e:
-            LOGGER.log(level=logging.ERROR, msg="Database error: %s " % e.args)
-            LOGGER.log(level=logging.ERROR, msg="Rollback transaction.")
-            session.rollback()
 
     def delete(self):
-        try:
+        with transaction():
             session.delete(self)
-            session.commit()
-            del self
-        except Exception as e:
-            LOGGER.log(level=logging.ERROR, msg="Database error: %s " % e.args)
-            LOGGER.log(level=logging.ERROR, msg="Rollback transaction.")
-            session.rollback()
 
 
 class Big(Model):
@@ -263,32 +498,13 @@ class Big(Model):
         return data
 
     def save(self, modify=False):
-        if not modify:
-            try:
+        with transaction(invalidate=self.__tablename__):
+            if not modify:
                 session.add(self)
-                session.commit()
-            except Exception as e:
-                LOGGER.log(level=logging.ERROR, msg="Database error: %s " % e.args)
-                LOGGER.log(level=logging.ERROR, msg="Rollback transaction.")
-                session.rollback()
-        else:
-            try:
-                session.flush()
-                session.commit()
-            except Exception as e:
-                LOGGER.log(level=logging.ERROR, msg="Database error: %s " % e.args)
-                LOGGER.log(level=logging.ERROR, msg="Rollback transaction.")
-                session.rollback()
 
     def delete(self):
-        try:
+        with transaction(invalidate=self.__tablename__):
             session.delete(self)
-            session.commit()
-            del self
-        except Exception as e:
-            LOGGER.log(level=logging.ERROR, msg="Database error: %s " % e.args)
-            LOGGER.log(level=logging.ERROR, msg="Rollback transaction.")
-            session.rollback()
 
 
 class Place(Model):
@@ -312,32 +528,13 @@ class Place(Model):
         return data
 
     def save(self, modify=False):
-        if not modify:
-            try:
+        with transaction(invalidate=self.__tablename__):
+            if not modify:
                 session.add(self)
-                session.commit()
-            except Exception as e:
-                LOGGER.log(level=logging.ERROR, msg="Database error: %s " % e.args)
-                LOGGER.log(level=logging.ERROR, msg="Rollback transaction.")
-                session.rollback()
-        else:
-            try:
-                session.flush()
-                session.commit()
-            except Exception as e:
-                LOGGER.log(level=logging.ERROR, msg="Database error: %s " % e.args)
-                LOGGER.log(level=logging.ERROR, msg="Rollback transaction.")
-                session.rollback()
 
     def delete(self):
-        try:
+        with transaction(invalidate=self.__tablename__):
             session.delete(self)
-            session.commit()
-            del self
-        except Exception as e:
-            LOGGER.log(level=logging.ERROR, msg="Database error: %s " % e.args)
-            LOGGER.log(level=logging.ERROR, msg="Rollback transaction.")
-            session.rollback()
 
 
 class Package(Model):
@@ -361,42 +558,23 @@ class Package(Model):
         return data
 
     def save(self, modify=False):
-        if not modify:
-            try:
+        with transaction(invalidate=self.__tablename__):
+            if not modify:
                 session.add(self)
-                session.commit()
-            except Exception as e:
-                LOGGER.log(level=logging.ERROR, msg="Database error: %s " % e.args)
-                LOGGER.log(level=logging.ERROR, msg="Rollback transaction.")
-                session.rollback()
-        else:
-            try:
-                session.flush()
-                session.commit()
-            except Exception as e:
-                LOGGER.log(level=logging.ERROR, msg="Database error: %s " % e.args)
-                LOGGER.log(level=logging.ERROR, msg="Rollback transaction.")
-                session.rollback()
 
     def delete(self):
-        try:
+        with transaction(invalidate=self.__tablename__):
             session.delete(self)
-            session.commit()
-            del self
-        except Exception as e:
-            LOGGER.log(level=logging.ERROR, msg="Database error: %s " % e.args)
-            LOGGER.log(level=logging.ERROR, msg="Rollback transaction.")
-            session.rollback()
 
 
 class Entity(Model):
     __tablename__ = 'entity'
     id = Column(Integer, primary_key=True, autoincrement=True, index=True)
     pipe_tag = Column(String, nullable=True)
-    name = Column(String, ForeignKey('entity_class.name'), index=True)
+    name = Column(String, ForeignKey('entity_class.name'))
     big = Column(Integer, ForeignKey('big.id'))
     inplace_count = Column(String, nullable=True)
-    package = Column(Integer, ForeignKey('package.id'), index=True, nullable=True)
+    package = Column(Integer, ForeignKey('package.id'), nullable=True)
     segment_number = Column(String, unique=True, nullable=True)
     weight = Column(Float, nullable=True)
     height = Column(Float, nullable=True)
@@ -406,8 +584,22 @@ class Entity(Model):
     fu = Column(Float, nullable=True)
     place_number = Column(Integer, nullable=True)
     extra = Column(String, nullable=True)
-    input_doc = Column(Integer, ForeignKey('movement_doc.id'), index=True)
+    input_doc = Column(Integer, ForeignKey('movement_doc.id'))
     output_doc = Column(Integer, ForeignKey('movement_doc.id'), index=True, nullable=True)
+    revision = Column(Integer, nullable=False, default=0, server_default='0')
+
+    # Составные индексы поиска, id в конце дает сортировку по id без отдельного шага и на Postgres.
+    # Индекс нужен на каждый набор фильтров: (big, package, id) для одного big уже не упорядочен по id.
+    __table_args__ = (
+        Index('ix_entity_name_id', 'name', 'id'),
+        Index('ix_entity_name_big_id', 'name', 'big', 'id'),
+        Index('ix_entity_big_id', 'big', 'id'),
+        Index('ix_entity_package_id', 'package', 'id'),
+        Index('ix_entity_big_package_id', 'big', 'package', 'id'),
+        Index('ix_entity_pipe_tag_id', 'pipe_tag', 'id'),
+        Index('ix_entity_place_number_id', 'place_number', 'id'),
+        Index('ix_entity_input_doc_output_doc', 'input_doc', 'output_doc'),
+    )
 
     def __init__(self, name, big, pipe_tag=None, inplace_count=None, package=None, segment_number=None, weight=None,
                  height=None,
@@ -448,11 +640,96 @@ class Entity(Model):
         entity = session.query(Entity).filter_by(id=id).one_or_none()
         return entity
 
+    @staticmethod
+    def get_revision(id):
+        return session.query(Entity.revision).filter_by(id=id).scalar()
+
+    @staticmethod
+    def get_many(ids, doc_id=None):
+        """
+        :param doc_id: только грузопозиции приходного документа doc_id
+        """
+        ids = [int(_) for _ in ids]
+        if not ids:
+            return []
+        query = session.query(Entity).filter(Entity.id.in_(ids))
+        if doc_id is not None:
+            query = query.filter(Entity.input_doc == doc_id)
+        return query.all()
+
     @staticmethod
     def get_all():
         data = session.query(Entity).all()
         return data
 
+    @staticmethod
+    def search_query(filters=None, date_from=None, date_to=None, sent_from=None, sent_to=None, sort='id',
+                     descending=False, after=None):
+        """
+        Запрос поиска грузопозиций.
+
+        :param filters: равенства по полям из ENTITY_FILTERS
+        :param date_from: дата приемки входящего документа, с
+        :param date_to: дата приемки входящего документа, по
+        :param sent_from: дата отправки входящего документа, с
+        :param sent_to: дата отправки входящего документа, по
+        :param sort: поле из ENTITY_SORT, при равенстве порядок по id
+        :param after: id последней грузопозиции предыдущей страницы, только для сортировки по id
+        """
+        query = session.query(Entity)
+        for key, value in (filters or {}).items():
+            query = query.filter(getattr(Entity, key) == value)
+        if any(_ is not None for _ in (date_from, date_to, sent_from, sent_to)):
+            # JOIN, а не IN (подзапрос): иначе при сортировке по id SQLite выбирает просмотр всей entity
+            docs = MovementDoc.select_ids(date_from=date_from, date_to=date_to, sent_from=sent_from,
+                                          sent_to=sent_to).subquery()
+            query = query.join(docs, Entity.input_doc == docs.c.id)
+        if after is not None:
+            query = query.filter(Entity.id < after if descending else Entity.id > after)
+        column = getattr(Entity, sort)
+        if descending:
+            return query.order_by(column.desc(), Entity.id.desc())
+        return query.order_by(column, Entity.id)
+
+    @staticmethod
+    def search(filters=None, date_from=None, date_to=None, sent_from=None, sent_to=None, sort='id',
+               descending=False, after=None, offset=None, limit=None):
+        query = Entity.search_query(filters, date_from, date_to, sent_from, sent_to, sort, descending, after)
+        if offset:
+            query = query.offset(offset)
+        if limit is not None:
+            query = query.limit(limit)
+        return query.all()
+
+    @staticmethod
+    def suggest(value, limit=10):
+        """
+        Подсказки по номеру сегмента, метке трубы, классу или доп. информации, новые грузопозиции первыми.
+
+        В SQLite каждое слово запроса ищется как начало слова в индексе FTS5, в Postgres - как
+        подстрока по триграммному индексу.
+
+        :return: список словарей id, segment_number, pipe_tag, name
+        """
+        words = re.findall(r'\w+', value.lower())
+        if not words or len(''.join(words)) < SUGGEST_MIN_LENGTH:
+            return []
+        if session.get_bind().dialect.name == 'sqlite':
+            # Слова запроса - фраза с префиксным поиском по последнему слову: "seg 0001" *
+            rows = session.execute(text(
+                "SELECT rowid, segment_number, pipe_tag, name FROM entity_fts WHERE entity_fts MATCH :match "
+                "ORDER BY rowid DESC LIMIT :limit"), dict(match='"%s" *' % ' '.join(words), limit=limit))
+        else:
+            params = dict(limit=limit)
+            conditions = []
+            for number, word in enumerate(words):
+                params['word%s' % number] = '%%%s%%' % word
+                conditions.append("%s ILIKE :word%s" % (SUGGEST_EXPRESSION, number))
+            rows = session.execute(text(
+                "SELECT id, segment_number, pipe_tag, name FROM entity WHERE %s ORDER BY id DESC LIMIT :limit"
+                % ' AND '.join(conditions)), params)
+        return [dict(id=_[0], segment_number=_[1], pipe_tag=_[2], name=_[3]) for _ in rows]
+
     @property
     def serialized(self):
         return dict(
@@ -476,32 +753,18 @@ class Entity(Model):
         )
 
     def save(self, modify=False):
-        if not modify:
-            try:
+        with transaction():
+            if not modify:
                 session.add(self)
-                session.commit()
-            except Exception as e:
-                LOGGER.log(level=logging.ERROR, msg="Database error: %s " % e.args)
-                LOGGER.log(level=logging.ERROR, msg="Rollback transaction.")
-                session.rollback()
-        else:
-            try:
                 session.flush()
-                session.commit()
-            except Exception as e:
-                LOGGER.log(level=logging.ERROR, msg="Database error: %s " % e.args)
-                LOGGER.log(level=logging.ERROR, msg="Rollback transaction.")
-                session.rollback()
+            self.revision = Revision.bump(DOCS_REVISION)
+            notify(self.__tablename__, 'update' if modify else 'insert', [self.id], DOCS_REVISION)
 
     def delete(self):
-        try:
+        with transaction():
             session.delete(self)
-            session.commit()
-            del self
-        except Exception as e:
-            LOGGER.log(level=logging.ERROR, msg="Database error: %s " % e.args)
-            LOGGER.log(level=logging.ERROR, msg="Rollback transaction.")
-            session.rollback()
+            Revision.bump(DOCS_REVISION)
+            notify(self.__tablename__, 'delete', [self.id], DOCS_REVISION)
 
 
 class DocType(Model):
@@ -526,32 +789,13 @@ class DocType(Model):
         return data
 
     def save(self, modify=False):
-        if not modify:
-            try:
+        with transaction(invalidate=self.__tablename__):
+            if not modify:
                 session.add(self)
-                session.commit()
-            except Exception as e:
-                LOGGER.log(level=logging.ERROR, msg="Database error: %s " % e.args)
-                LOGGER.log(level=logging.ERROR, msg="Rollback transaction.")
-                session.rollback()
-        else:
-            try:
-                session.flush()
-                session.commit()
-            except Exception as e:
-                LOGGER.log(level=logging.ERROR, msg="Database error: %s " % e.args)
-                LOGGER.log(level=logging.ERROR, msg="Rollback transaction.")
-                session.rollback()
 
     def delete(self):
-        try:
+        with transaction(invalidate=self.__tablename__):
             session.delete(self)
-            session.commit()
-            del self
-        except Exception as e:
-            LOGGER.log(level=logging.ERROR, msg="Database error: %s " % e.args)
-            LOGGER.log(level=logging.ERROR, msg="Rollback transaction.")
-            session.rollback()
 
 
 class Port(Model):
@@ -575,32 +819,13 @@ class Port(Model):
         return data
 
     def save(self, modify=False):
-        if not modify:
-            try:
+        with transaction(invalidate=self.__tablename__):
+            if not modify:
                 session.add(self)
-                session.commit()
-            except Exception as e:
-                LOGGER.log(level=logging.ERROR, msg="Database error: %s " % e.args)
-                LOGGER.log(level=logging.ERROR, msg="Rollback transaction.")
-                session.rollback()
-        else:
-            try:
-                session.flush()
-                session.commit()
-            except Exception as e:
-                LOGGER.log(level=logging.ERROR, msg="Database error: %s " % e.args)
-                LOGGER.log(level=logging.ERROR, msg="Rollback transaction.")
-                session.rollback()
 
     def delete(self):
-        try:
+        with transaction(invalidate=self.__tablename__):
             session.delete(self)
-            session.commit()
-            del self
-        except Exception as e:
-            LOGGER.log(level=logging.ERROR, msg="Database error: %s " % e.args)
-            LOGGER.log(level=logging.ERROR, msg="Rollback transaction.")
-            session.rollback()
 
 
 class Object(Model):
@@ -623,32 +848,13 @@ class Object(Model):
         return data
 
     def save(self, modify=False):
-        if not modify:
-            try:
+        with transaction(invalidate=self.__tablename__):
+            if not modify:
                 session.add(self)
-                session.commit()
-            except Exception as e:
-                LOGGER.log(level=logging.ERROR, msg="Database error: %s " % e.args)
-                LOGGER.log(level=logging.ERROR, msg="Rollback transaction.")
-                session.rollback()
-        else:
-            try:
-                session.flush()
-                session.commit()
-            except Exception as e:
-                LOGGER.log(level=logging.ERROR, msg="Database error: %s " % e.args)
-                LOGGER.log(level=logging.ERROR, msg="Rollback transaction.")
-                session.rollback()
 
     def delete(self):
-        try:
+        with transaction(invalidate=self.__tablename__):
             session.delete(self)
-            session.commit()
-            del self
-        except Exception as e:
-            LOGGER.log(level=logging.ERROR, msg="Database error: %s " % e.args)
-            LOGGER.log(level=logging.ERROR, msg="Rollback transaction.")
-            session.rollback()
 
 
 class MovementDoc(Model):
@@ -669,7 +875,14 @@ class MovementDoc(Model):
     place = Column(Integer, ForeignKey('place.id'))
     big = Column(Integer, ForeignKey('big.id'))
     extra = Column(String, nullable=True)
-    entities = Column(String)
+    revision = Column(Integer, nullable=False, default=0, server_default='0')
+    entities = relationship('Entity', secondary='movement_doc_entity', order_by='DocEntity.position',
+                            viewonly=True)
+
+    __table_args__ = (
+        Index('ix_movement_doc_receive_date_id', 'receive_date', 'id'),
+        Index('ix_movement_doc_send_date_id', 'send_date', 'id'),
+    )
 
     @staticmethod
     def get_all():
@@ -681,8 +894,135 @@ class MovementDoc(Model):
         doc = session.query(MovementDoc).filter_by(id=id).one_or_none()
         return doc
 
+    @staticmethod
+    def get_revision(id):
+        return session.query(MovementDoc.revision).filter_by(id=id).scalar()
+
+    @staticmethod
+    def get_page(after=None, limit=None):
+        query = session.query(MovementDoc).order_by(MovementDoc.id)
+        if after is not None:
+            query = query.filter(MovementDoc.id > after)
+        if limit is not None:
+            query = query.limit(limit)
+        return query.all()
+
+    @staticmethod
+    def delete_many(ids):
+        """
+        Удаление документов вместе с их грузопозициями одной транзакцией.
+
+        :param ids: список id или select с id документов
+        :return: количество удаленных документов
+        """
+        with transaction(reraise=True):
+            revision = Revision.bump(DOCS_REVISION)
+            # Отгруженные удаляемыми расходами грузопозиции меняются, и вместе с ними - приходы,
+            # в ответ которых они входят
+            shipped = [_[0] for _ in session.query(Entity.input_doc).distinct()
+                       .filter(Entity.output_doc.in_(ids), ~Entity.input_doc.in_(ids))]
+            MovementDoc.lock(or_(MovementDoc.id.in_(ids), MovementDoc.id.in_(shipped)))
+            # Грузопозиции удаляемых приходов уходят из остатков, отгруженные удаляемыми расходами возвращаются
+            removed = Stock.on_hand(Entity.input_doc.in_(ids))
+            returned = Stock.aggregate(and_(Entity.output_doc.in_(ids),
+                                            or_(Entity.input_doc.is_(None), ~Entity.input_doc.in_(ids))))
+            if shipped:
+                session.query(MovementDoc).filter(MovementDoc.id.in_(shipped)) \
+                    .update({MovementDoc.revision: revision}, synchronize_session=False)
+                notify(DOCS_REVISION, 'update', shipped, DOCS_REVISION)
+            session.query(Entity).filter(Entity.output_doc.in_(ids)) \
+                .update({Entity.output_doc: None, Entity.revision: revision}, synchronize_session=False)
+            session.query(Entity).filter(Entity.input_doc.in_(ids)).delete(synchronize_session=False)
+            session.query(DocEntity).filter(DocEntity.doc.in_(ids)).delete(synchronize_session=False)
+            deleted = session.query(MovementDoc).filter(MovementDoc.id.in_(ids)).delete(synchronize_session=False)
+            Stock.apply(returned, removed)
+            # Для удаления по select без списка id событие без ids: клиент перечитывает документы
+            notify(DOCS_REVISION, 'delete', ids if isinstance(ids, (list, tuple, set)) else None, DOCS_REVISION)
+        return deleted
+
+    @staticmethod
+    def lock(condition):
+        """
+        Блокировка строк документов до конца транзакции перед чтением остатков по их грузопозициям:
+        иначе параллельная запись тех же грузопозиций между чтением и Stock.apply разошлась бы со сводкой.
+
+        В Postgres - SELECT ... FOR UPDATE в порядке id. В SQLite писатель один на всю базу, и блокировку
+        записи до конца транзакции уже взял Revision.bump, поэтому его вызывают первым.
+        """
+        if session.get_bind().dialect.name == 'postgresql':
+            session.query(MovementDoc.id).filter(condition).order_by(MovementDoc.id).with_for_update().all()
+
+    @staticmethod
+    def select_ids(ids=None, date_from=None, date_to=None, sent_from=None, sent_to=None):
+        query = select(MovementDoc.id)
+        if ids is not None:
+            query = query.where(MovementDoc.id.in_(ids))
+        if date_from is not None:
+            query = query.where(MovementDoc.receive_date >= date_from)
+        if date_to is not None:
+            query = query.where(MovementDoc.receive_date <= date_to)
+        if sent_from is not None:
+            query = query.where(MovementDoc.send_date >= sent_from)
+        if sent_to is not None:
+            query = query.where(MovementDoc.send_date <= sent_to)
+        return query
+
+    def save_changes(self, fields, entity_changes):
+        """
+        Изменения документа и его грузопозиций одной транзакцией.
+
+        :param fields: измененные поля документа
+        :param entity_changes: список словарей с id и измененными полями грузопозиций
+        """
+        with transaction(reraise=True):
+            revision = Revision.bump(DOCS_REVISION)
+            MovementDoc.lock(MovementDoc.id == self.id)
+            before = Stock.on_hand(Entity.input_doc == self.id)
+            for key, value in fields.items():
+                setattr(self, key, value)
+            self.revision = revision
+            for _ in entity_changes:
+                _['revision'] = revision
+            if entity_changes:
+                session.bulk_update_mappings(Entity, entity_changes)
+            Stock.apply(Stock.on_hand(Entity.input_doc == self.id), before)
+            # Грузопозиции документа не перечисляются: событие остается компактным при любом размере
+            notify(DOCS_REVISION, 'update', [self.id], DOCS_REVISION)
+
+    def save_with_entities(self, entities, job=None, claimed=None):
+        """
+        :param job: id задания фоновой загрузки, оно отмечается выполненным в той же транзакции:
+            задание, повторно взятое в работу после сбоя, не создаст второй документ
+        :param claimed: время взятия задания в работу, которое вернул IngestJob.claim
+        """
+        with transaction(reraise=True):
+            revision = Revision.bump(DOCS_REVISION)
+            self.revision = revision
+            session.add(self)
+            session.flush()
+            EntityClass.ensure(_.name for _ in entities)
+            columns = [_.key for _ in Entity.__table__.columns if _.key != 'id']
+            rows = []
+            for _ in entities:
+                _.input_doc = self.id
+                _.revision = revision
+                rows.append({key: getattr(_, key) for key in columns})
+            # Один executemany: bulk_save_objects с return_defaults вставляет по строке, чтобы получить id.
+            # Id новых грузопозиций документа растут в порядке вставки и читаются одним запросом.
+            session.execute(Entity.__table__.insert(), rows)
+            ids = session.query(Entity.id).filter(Entity.input_doc == self.id).order_by(Entity.id)
+            for entity, (entity_id,) in zip(entities, ids):
+                entity.id = entity_id
+            session.bulk_insert_mappings(DocEntity, [
+                dict(doc=self.id, entity=_.id, position=position) for position, _ in enumerate(entities)
+            ])
+            Stock.apply(Stock.on_hand(Entity.input_doc == self.id))
+            if job is not None:
+                IngestJob.complete(job, claimed, doc=self.id)
+            notify(DOCS_REVISION, 'insert', [self.id], DOCS_REVISION)
+
     @property
-    def serialized(self):
+    def header(self):
         data = dict(
             id=self.id,
             tag=self.tag,
@@ -701,41 +1041,332 @@ class MovementDoc(Model):
             big=self.big,
             extra=self.extra,
         )
-        entities = json.loads(self.entities)
-        entity_buf = []
-        for _ in entities:
-            entity = Entity.get(_)
-            entity_buf.append(entity.serialized)
-        data["entities"] = entity_buf
         return data
 
+    @property
+    def serialized(self):
+        return serialize_docs([self])[0]
+
     def save(self, modify=False):
-        if not modify:
-            try:
+        with transaction():
+            if not modify:
                 session.add(self)
-                session.commit()
-            except Exception as e:
-                LOGGER.log(level=logging.ERROR, msg="Database error: %s " % e.args)
-                LOGGER.log(level=logging.ERROR, msg="Rollback transaction.")
-                session.rollback()
-        else:
-            try:
                 session.flush()
-                session.commit()
-            except Exception as e:
-                LOGGER.log(level=logging.ERROR, msg="Database error: %s " % e.args)
-                LOGGER.log(level=logging.ERROR, msg="Rollback transaction.")
-                session.rollback()
+            self.revision = Revision.bump(DOCS_REVISION)
+            notify(DOCS_REVISION, 'update' if modify else 'insert', [self.id], DOCS_REVISION)
 
     def delete(self):
+        """
+        Удаление документа вместе с грузопозициями, как DELETE /api/v1/doc/{id}.
+        """
+        MovementDoc.delete_many([self.id])
+
+
+class DocEntity(Model):
+    __tablename__ = 'movement_doc_entity'
+    doc = Column(Integer, ForeignKey('movement_doc.id', ondelete='CASCADE'), primary_key=True)
+    entity = Column(Integer, ForeignKey('entity.id', ondelete='CASCADE'), primary_key=True, index=True)
+    position = Column(Integer, nullable=False)
+
+    __table_args__ = (
+        Index('ix_movement_doc_entity_doc_position', 'doc', 'position'),
+    )
+
+
+class Revision(Model):
+    """
+    Счетчики изменений для ETag.
+
+    Значение растет при каждой записи в таблицы, каждая измененная строка получает
+    номер ревизии своей транзакции в колонку revision, поэтому пара (id, revision) не повторяется
+    даже при переиспользовании id после удаления.
+    """
+    __tablename__ = 'revision'
+    name = Column(String, primary_key=True)
+    value = Column(Integer, nullable=False, default=0)
+
+    @staticmethod
+    def bump(name):
+        """
+        Номер ревизии для строк, которые меняет текущая транзакция.
+
+        В Postgres номер берется из revision_seq без блокировок, а строка счетчика name обновляется
+        перед commit (commit_revisions): блокировка строки с первой записи до commit выстроила бы
+        в очередь записи документов всех воркеров, в том числе на время загрузки больших документов.
+        SQLite допускает одного писателя на всю базу, там счетчик обновляется сразу.
+        """
+        revisions = session.info.setdefault('revisions', {})
+        if session.get_bind().dialect.name == 'postgresql':
+            revisions[name] = None
+            return session.execute(select(REVISION_SEQUENCE.next_value())).scalar()
+        revisions[name] = Revision.advance(session, name)
+        return revisions[name]
+
+    @staticmethod
+    def advance(db_session, name):
+        postgres = db_session.get_bind().dialect.name == 'postgresql'
+        value = REVISION_SEQUENCE.next_value() if postgres else Revision.value + 1
+        updated = db_session.query(Revision).filter_by(name=name) \
+            .update({Revision.value: value}, synchronize_session=False)
+        if not updated:
+            db_session.add(Revision(name=name, value=REVISION_SEQUENCE.next_value() if postgres else 1))
+            db_session.flush()
+        return db_session.query(Revision.value).filter_by(name=name).scalar()
+
+    @staticmethod
+    def current(name):
+        return session.query(Revision.value).filter_by(name=name).scalar() or 0
+
+    @staticmethod
+    def all():
+        return dict(session.query(Revision.name, Revision.value))
+
+
+class Stock(Model):
+    """
+    Остатки: грузопозиции без расходного документа, сгруппированные по укрупненной номенклатуре,
+    классу и месту приходного документа.
+
+    Запись документов движения меняет сводку приращениями в той же транзакции,
+    полный пересчет - Stock.rebuild (python stock.py).
+    """
+    __tablename__ = 'stock'
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    big = Column(Integer, ForeignKey('big.id'), nullable=True)
+    entity_class = Column(String, ForeignKey('entity_class.name'), nullable=True)
+    place = Column(Integer, ForeignKey('place.id'), nullable=True)
+    count = Column(Integer, nullable=False, default=0)
+    weight = Column(Float, nullable=False, default=0)
+    fu = Column(Float, nullable=False, default=0)
+
+    # NULL не равен NULL в уникальном индексе, поэтому группа сравнивается через coalesce:
+    # иначе первые параллельные записи одной группы с пустым местом создали бы две строки
+    group_key = (func.coalesce(big, literal_column('0')), func.coalesce(entity_class, literal_column("''")),
+                 func.coalesce(place, literal_column('0')))
+
+    __table_args__ = (
+        Index('ix_stock_group', *group_key, unique=True),
+    )
+
+    @staticmethod
+    def aggregate(condition):
+        """
+        Группы остатков для грузопозиций по условию, расходный документ не проверяется.
+
+        :return: {(big, entity_class, place): [count, weight, fu]}
+        """
+        rows = session.query(Entity.big, Entity.name, MovementDoc.place, func.count(Entity.id),
+                             func.coalesce(func.sum(Entity.weight), 0), func.coalesce(func.sum(Entity.fu), 0)) \
+            .outerjoin(MovementDoc, MovementDoc.id == Entity.input_doc) \
+            .filter(condition).group_by(Entity.big, Entity.name, MovementDoc.place)
+        return {(_[0], _[1], _[2]): [_[3], _[4], _[5]] for _ in rows}
+
+    @staticmethod
+    def on_hand(condition=None):
+        if condition is None:
+            return Stock.aggregate(Entity.output_doc.is_(None))
+        return Stock.aggregate(and_(Entity.output_doc.is_(None), condition))
+
+    @staticmethod
+    def apply(added=None, removed=None):
+        """
+        Приращение сводки: added прибавляется, removed вычитается. Коммит делает вызывающий код.
+        """
+        delta = {}
+        for groups, sign in ((added or {}, 1), (removed or {}, -1)):
+            for key, values in groups.items():
+                total = delta.setdefault(key, [0, 0.0, 0.0])
+                for index, value in enumerate(values):
+                    total[index] += sign * (value or 0)
+        rows = [dict(big=big, entity_class=entity_class, place=place, count=count, weight=weight, fu=fu)
+                for (big, entity_class, place), (count, weight, fu) in delta.items() if count or weight or fu]
+        if not rows:
+            return
+        insert = STOCK_UPSERT.get(session.get_bind().dialect.name)
+        if insert is not None:
+            # Один INSERT ... ON CONFLICT на все группы: строку группы, вставленную параллельной транзакцией,
+            # он увеличивает, а не дублирует
+            statement = insert(Stock.__table__)
+            session.execute(statement.on_conflict_do_update(index_elements=Stock.group_key, set_=dict(
+                count=Stock.count + statement.excluded.count, weight=Stock.weight + statement.excluded.weight,
+                fu=Stock.fu + statement.excluded.fu
+            )), rows)
+        else:
+            for _ in rows:
+                updated = session.query(Stock).filter(
+                    Stock.big == _['big'], Stock.entity_class == _['entity_class'], Stock.place == _['place']) \
+                    .update({Stock.count: Stock.count + _['count'], Stock.weight: Stock.weight + _['weight'],
+                             Stock.fu: Stock.fu + _['fu']}, synchronize_session=False)
+                if not updated:
+                    session.add(Stock(**_))
+        if any(_['count'] < 0 for _ in rows):
+            session.query(Stock).filter(Stock.count <= 0).delete(synchronize_session=False)
+
+    @staticmethod
+    def rebuild():
+        """
+        Пересчет сводки по всем грузопозициям.
+
+        :return: количество групп
+        """
+        with transaction(reraise=True):
+            session.query(Stock).delete(synchronize_session=False)
+            groups = Stock.on_hand()
+            session.bulk_insert_mappings(Stock, [
+                dict(big=big, entity_class=entity_class, place=place, count=count, weight=weight, fu=fu)
+                for (big, entity_class, place), (count, weight, fu) in groups.items()
+            ])
+        return len(groups)
+
+    @staticmethod
+    def summary(group=STOCK_GROUPS, filters=None):
+        """
+        Остатки, сгруппированные по полям group из STOCK_GROUPS, без group - общий итог.
+        """
+        columns = [getattr(Stock, _) for _ in group]
+        query = session.query(*columns, func.sum(Stock.count), func.sum(Stock.weight), func.sum(Stock.fu))
+        for key, value in (filters or {}).items():
+            query = query.filter(getattr(Stock, key) == value)
+        if columns:
+            query = query.group_by(*columns).order_by(*columns)
+        data = []
+        for row in query:
+            item = dict(zip(group, row))
+            item.update(count=row[-3] or 0, weight=row[-2] or 0, fu=row[-1] or 0)
+            data.append(item)
+        return data
+
+
+class IngestJob(Model):
+    """
+    Задание фоновой загрузки документа движения (PUT /api/v1/doc?async=1).
+
+    Тело запроса хранится до окончания загрузки, поэтому задания из очереди переживают перезапуск.
+    key - Idempotency-Key клиента: повтор запроса с тем же ключом возвращает то же задание.
+    """
+    __tablename__ = 'ingest_job'
+    id = Column(String, primary_key=True)
+    key = Column(String, unique=True, nullable=True)
+    status = Column(String, nullable=False, default=JOB_QUEUED)
+    payload = Column(String, nullable=True)
+    entities = Column(Integer, nullable=False, default=0)
+    doc = Column(Integer, nullable=True)
+    error = Column(String, nullable=True)
+    created = Column(DateTime, nullable=False)
+    claimed = Column(DateTime, nullable=True)
+    finished = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        Index('ix_ingest_job_status_created', 'status', 'created'),
+    )
+
+    @staticmethod
+    def get(id):
+        return session.query(IngestJob).filter_by(id=id).one_or_none()
+
+    @staticmethod
+    def get_by_key(key):
+        return session.query(IngestJob).filter_by(key=key).one_or_none()
+
+    @staticmethod
+    def create(key, payload, entities):
+        """
+        :return: (задание, True) или (задание с тем же key, False), если его успел создать параллельный повтор
+        """
+        job = IngestJob(id=uuid.uuid4().hex, key=key, status=JOB_QUEUED, payload=payload, entities=entities,
+                        created=datetime.now())
         try:
-            session.delete(self)
+            session.add(job)
             session.commit()
-            del self
-        except Exception as e:
-            LOGGER.log(level=logging.ERROR, msg="Database error: %s " % e.args)
-            LOGGER.log(level=logging.ERROR, msg="Rollback transaction.")
+        except IntegrityError:
             session.rollback()
+            if key is None:
+                raise
+            return IngestJob.get_by_key(key), False
+        return job, True
+
+    @staticmethod
+    def claim(id):
+        """
+        queued -> running одним UPDATE: задание, попавшее в очереди нескольких процессов, выполнит один.
+
+        :return: время взятия в работу, по нему complete и finish узнают свой запуск, или None
+        """
+        now = datetime.now()
+        with transaction(reraise=True):
+            claimed = session.query(IngestJob).filter_by(id=id, status=JOB_QUEUED) \
+                .update({IngestJob.status: JOB_RUNNING, IngestJob.claimed: now}, synchronize_session=False)
+        return now if claimed == 1 else None
+
+    @staticmethod
+    def complete(id, claimed, doc):
+        """
+        Отметка о загрузке в текущей транзакции, коммит делает вызывающий код.
+
+        Задание, которое release вернул в очередь и взял другой процесс, этим запуском уже не отмечается:
+        исключение откатывает транзакцию вместе с документом.
+        """
+        # Тело загруженного документа больше не нужно, у неудачного остается для разбора
+        updated = session.query(IngestJob).filter_by(id=id, status=JOB_RUNNING, claimed=claimed).update(dict(
+            status=JOB_DONE, doc=doc, error=None, payload=None, finished=datetime.now()
+        ), synchronize_session=False)
+        if updated != 1:
+            raise RuntimeError("Ingest job %s is no longer claimed by this run" % id)
+
+    @staticmethod
+    def finish(id, claimed, error):
+        """
+        :return: False, если задание уже выполняет другой процесс, и отметка не записана
+        """
+        with transaction(reraise=True):
+            updated = session.query(IngestJob).filter_by(id=id, status=JOB_RUNNING, claimed=claimed).update(dict(
+                status=JOB_FAILED, error=error, finished=datetime.now()
+            ), synchronize_session=False)
+        return updated == 1
+
+    @staticmethod
+    def release(before):
+        """
+        running -> queued для заданий, взятых в работу раньше before: процесс, который их выполнял,
+        остановился, не записав результат.
+        """
+        with transaction(reraise=True):
+            released = session.query(IngestJob) \
+                .filter(IngestJob.status == JOB_RUNNING, or_(IngestJob.claimed < before, IngestJob.claimed.is_(None))) \
+                .update({IngestJob.status: JOB_QUEUED, IngestJob.claimed: None}, synchronize_session=False)
+        return released
+
+    @staticmethod
+    def discard(id):
+        with transaction():
+            session.query(IngestJob).filter_by(id=id).delete(synchronize_session=False)
+
+    @staticmethod
+    def pending(limit):
+        rows = session.query(IngestJob.id).filter_by(status=JOB_QUEUED).order_by(IngestJob.created).limit(limit)
+        return [_[0] for _ in rows]
+
+    @staticmethod
+    def purge(before):
+        """
+        Удаление завершенных заданий старше before.
+        """
+        with transaction(reraise=True):
+            deleted = session.query(IngestJob).filter(IngestJob.finished < before) \
+                .delete(synchronize_session=False)
+        return deleted
+
+    @property
+    def serialized(self):
+        return dict(
+            id=self.id,
+            status=self.status,
+            entities=self.entities,
+            doc=self.doc,
+            error=self.error,
+            created=self.created,
+            finished=self.finished
+        )
 
 
 class People(Model):
@@ -748,4 +1379,18 @@ class People(Model):
         return data
 
 
-Model.metadata.create_all(dbengine)
+def create_search_index(target, connection, **kw):
+    """
+    Индекс подсказок для новой таблицы entity, для существующей - migrations.create_entity_search.
+    """
+    if connection.dialect.name == 'sqlite':
+        statements = ENTITY_SEARCH_SQLITE
+    elif connection.dialect.name == 'postgresql':
+        statements = ENTITY_SEARCH_POSTGRES
+    else:
+        return
+    for _ in statements:
+        connection.exec_driver_sql(_)
+
+
+event.listen(Entity.__table__, 'after_create', create_search_index)
@@ -0,0 +1,265 @@
+"""
+Потоковая выгрузка документов движения с грузопозициями в CSV, XLSX и Parquet.
+
+Первые колонки повторяют раскладку importer.COLUMNS, поэтому выгруженный XLSX можно загрузить
+обратно через importer.py. Остальные поля документа и грузопозиции идут после них.
+"""
+import io
+import csv
+import tempfile
+
+from openpyxl import Workbook
+from sqlalchemy.orm import aliased
+
+from database import session, MovementDoc, Entity, Contragent, Big, Package, Port, TransportType, DocType, Place
+from importer import COLUMNS, FIRST_ROW
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+EXPORT_BATCH = 2000
+XLSX_SHEET = 'Лист1'
+XLSX_CHUNK = 65536
+
+TITLES = dict(
+    doc_num="Номер документа",
+    provider="Поставщик",
+    object="Объект",
+    entity_class="Класс",
+    big="Укрупненная номенклатура",
+    entity_serial="Номер сегмента",
+    package="Упаковка",
+    weight="Вес",
+    port="Порт",
+    transport_type="Тип транспорта",
+    transport="Транспорт"
+)
+
+EXTRA_COLUMNS = (
+    ('doc_id', "Id документа"),
+    ('doc_type', "Тип документа"),
+    ('receiver', "Получатель"),
+    ('place', "Место"),
+    ('send_date', "Дата отправки"),
+    ('receive_date', "Дата приемки"),
+    ('contract', "Договор"),
+    ('entity_id', "Id грузопозиции"),
+    ('pipe_tag', "Метка трубы"),
+    ('length', "Длина"),
+    ('diameter', "Диаметр"),
+    ('thickness', "Толщина стенки"),
+    ('fu', "Fu"),
+    ('place_number', "Номер места"),
+    ('output_doc', "Расходный документ")
+)
+
+FLOAT_COLUMNS = ('weight', 'length', 'diameter', 'thickness', 'fu')
+INT_COLUMNS = ('doc_id', 'entity_id', 'place_number', 'output_doc')
+DATE_COLUMNS = ('send_date', 'receive_date')
+
+EXPORT_FORMATS = dict(
+    csv='text/csv',
+    xlsx='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    parquet='application/vnd.apache.parquet'
+)
+
+
+def layout():
+    """
+    Имена и заголовки колонок выгрузки: позиции importer.COLUMNS, пустые колонки между ними, затем EXTRA_COLUMNS.
+    """
+    width = max(COLUMNS.values()) + 1
+    names = [None] * width
+    for name, index in COLUMNS.items():
+        names[index] = name
+    columns = [(_ or 'column_%s' % index, TITLES.get(_, '')) for index, _ in enumerate(names)]
+    return columns + list(EXTRA_COLUMNS)
+
+
+def export_query(date_from=None, date_to=None, doc_type=None):
+    sender = aliased(Contragent)
+    receiver = aliased(Contragent)
+    query = session.query(
+        MovementDoc.tag.label('doc_num'),
+        sender.name.label('provider'),
+        MovementDoc.object.label('object'),
+        Entity.name.label('entity_class'),
+        Big.name.label('big'),
+        Entity.segment_number.label('entity_serial'),
+        Package.name.label('package'),
+        Entity.weight.label('weight'),
+        Port.name.label('port'),
+        TransportType.name.label('transport_type'),
+        MovementDoc.transport_tag.label('transport'),
+        MovementDoc.id.label('doc_id'),
+        DocType.name.label('doc_type'),
+        receiver.name.label('receiver'),
+        Place.name.label('place'),
+        MovementDoc.send_date.label('send_date'),
+        MovementDoc.receive_date.label('receive_date'),
+        MovementDoc.contract.label('contract'),
+        Entity.id.label('entity_id'),
+        Entity.pipe_tag.label('pipe_tag'),
+        Entity.height.label('length'),
+        Entity.diameter.label('diameter'),
+        Entity.thickness.label('thickness'),
+        Entity.fu.label('fu'),
+        Entity.place_number.label('place_number'),
+        Entity.output_doc.label('output_doc')
+    ).select_from(Entity).join(MovementDoc, MovementDoc.id == Entity.input_doc) \
+        .outerjoin(sender, sender.id == MovementDoc.sender) \
+        .outerjoin(receiver, receiver.id == MovementDoc.receiver) \
+        .outerjoin(Big, Big.id == Entity.big) \
+        .outerjoin(Package, Package.id == Entity.package) \
+        .outerjoin(Port, Port.id == MovementDoc.port) \
+        .outerjoin(TransportType, TransportType.id == MovementDoc.transport_type) \
+        .outerjoin(DocType, DocType.id == MovementDoc.type) \
+        .outerjoin(Place, Place.id == MovementDoc.place)
+    if date_from is not None:
+        query = query.filter(MovementDoc.receive_date >= date_from)
+    if date_to is not None:
+        query = query.filter(MovementDoc.receive_date <= date_to)
+    if doc_type is not None:
+        query = query.filter(MovementDoc.type == doc_type)
+    # Порядок по индексу entity (input_doc, id): без сортировки во временном B-дереве на всю выгрузку
+    return query.order_by(Entity.input_doc, Entity.id)
+
+
+def export_batches(date_from=None, date_to=None, doc_type=None, batch=EXPORT_BATCH):
+    """
+    Строки выгрузки пачками в порядке layout(). yield_per читает курсор порциями
+    (на Postgres - серверный курсор), весь результат в память не загружается.
+    """
+    names = [_[0] for _ in layout()]
+    rows = []
+    for row in export_query(date_from, date_to, doc_type).yield_per(batch):
+        values = row._mapping
+        rows.append([values.get(_) for _ in names])
+        if len(rows) >= batch:
+            yield rows
+            rows = []
+    if rows:
+        yield rows
+
+
+def csv_chunks(batches):
+    columns = layout()
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([title or name for name, title in columns])
+    # BOM, чтобы Excel открыл файл в UTF-8
+    first = True
+    for rows in batches:
+        writer.writerows(rows)
+        data = buffer.getvalue().encode('utf-8-sig' if first else 'utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+        first = False
+        yield data
+    if first:
+        yield buffer.getvalue().encode('utf-8-sig')
+
+
+def xlsx_chunks(batches):
+    """
+    XLSX в формате отчета для importer.py: заголовки, строка с номерами колонок, данные с FIRST_ROW.
+
+    Лист в режиме write_only пишется во временный файл по мере чтения строк, архив
+    собирается в конце и отдается порциями, память не зависит от размера выгрузки.
+    """
+    columns = layout()
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet(XLSX_SHEET)
+    sheet.append([title for name, title in columns])
+    for _ in range(FIRST_ROW - 2):
+        sheet.append(list(range(1, len(columns) + 1)))
+    for rows in batches:
+        for row in rows:
+            sheet.append(row)
+    with tempfile.TemporaryFile() as file:
+        workbook.save(file)
+        file.seek(0)
+        while True:
+            data = file.read(XLSX_CHUNK)
+            if not data:
+                break
+            yield data
+
+
+class ChunkSink(object):
+    """
+    Файловый объект для писателя Parquet: записанные байты забираются порциями через drain().
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def writable(self):
+        return True
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def parquet_schema():
+    fields = []
+    for name, title in layout():
+        if name in FLOAT_COLUMNS:
+            kind = pyarrow.float64()
+        elif name in INT_COLUMNS:
+            kind = pyarrow.int64()
+        elif name in DATE_COLUMNS:
+            kind = pyarrow.timestamp('us')
+        else:
+            kind = pyarrow.string()
+        fields.append(pyarrow.field(name, kind))
+    return pyarrow.schema(fields)
+
+
+def parquet_chunks(batches):
+    """
+    Parquet: каждая пачка строк - отдельная группа строк, отдается сразу после записи.
+    """
+    schema = parquet_schema()
+    sink = ChunkSink()
+    writer = pyarrow.parquet.ParquetWriter(sink, schema)
+    try:
+        for rows in batches:
+            columns = list(zip(*rows))
+            writer.write_table(pyarrow.Table.from_arrays(
+                [pyarrow.array(_, type=field.type) for _, field in zip(columns, schema)], schema=schema))
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
+
+
+def export_chunks(fmt, date_from=None, date_to=None, doc_type=None):
+    batches = export_batches(date_from, date_to, doc_type)
+    if fmt == 'xlsx':
+        return xlsx_chunks(batches)
+    if fmt == 'parquet':
+        return parquet_chunks(batches)
+    return csv_chunks(batches)
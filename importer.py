@@ -1,61 +1,360 @@
+import os
+import glob
+import time
+import argparse
+from queue import Empty
+from multiprocessing import Manager
+from concurrent.futures import ProcessPoolExecutor
+
 import pandas as pd
-import json
-from database import Contragent, MovementDoc, Entity, EntityClass, DocType, Transport, Big, Package, Port, Object, TransportType
-
-df = pd.read_excel('otchet.xlsx', sheet_name='Лист1')
-
-for _ in range(1, df.size):
-    doc_num = df.values[_][0]
-    provider = df.values[_][1]
-    entity_class = df.values[_][3]
-    entity_big = df.values[_][4]
-    entity_serial = df.values[_][5]
-    package = df.values[_][7]
-    weight = df.values[_][13]
-    transport = df.values[_][22]
-    transport_type = df.values[_][21]
-    port = df.values[_][18]
-    object = df.values[_][2]
-    print(doc_num, provider, entity_class, entity_big, entity_serial, package, weight, transport)
-
-    contragent = Contragent.get_by_name(provider)
-    if not contragent:
-        new = Contragent(name=provider)
-        new.save()
-
-    big = Big.get_by_name(entity_big)
-    if not big:
-        new = Big(name=entity_big)
-        new.save()
-
-    _package = Package.get_by_name(package)
-    if not _package:
-        new = Package(name=package)
-        new.save()
-
-    _transport_type = TransportType.get_by_name(transport_type)
-    if not _transport_type:
-        new = TransportType(name=_transport_type)
-        new.save()
-
-    _transport = Transport.get_by_tag(transport)
-    if not _transport:
-        new = Transport(tag=transport, type=transport_type)
-        new.save()
-
-    for _dt in ("Приёмка", "Отгрузка", "Внутреннее перемещение"):
-        dt = DocType.get_by_name(_dt)
-        if not dt:
-            new_dt = DocType(name=_dt)
-            new_dt.save()
-
-    _port = Port.get_by_name(port)
-    if not _port:
-        new_port = Port(name=port)
-        new_port.save()
-
-    if type(object) == str and len(object) > 0:
-        _object = Object.get(object)
-        if not _object:
-            new_object = Object(id=object)
-            new_object.save()
+from openpyxl import load_workbook
+from sqlalchemy import func, and_
+
+import logging
+from logs import get_logger
+
+from database import session, Contragent, DocType, Transport, Big, Package, Port, Object, TransportType, \
+    MovementDoc, Entity, EntityClass, DocEntity, Revision, Stock, DOCS_REVISION, init_db
+
+LOGGER = get_logger()
+
+COLUMNS = dict(
+    doc_num=0,
+    provider=1,
+    object=2,
+    entity_class=3,
+    big=4,
+    entity_serial=5,
+    package=7,
+    weight=13,
+    port=18,
+    transport_type=21,
+    transport=22
+)
+
+DOC_TYPES = ("Приёмка", "Отгрузка", "Внутреннее перемещение")
+IMPORT_DOC_TYPE = "Приёмка"
+
+# Первая строка листа - заголовок, вторая, как и раньше, не импортируется.
+FIRST_ROW = 3
+CHUNK_SIZE = 5000
+# Секунд ожидания порции, после которых писатель проверяет, не завершился ли процесс пула без маркера
+QUEUE_TIMEOUT = 1.0
+
+
+def clean(value):
+    if value is None or pd.isna(value):
+        return None
+    value = str(value).strip()
+    return value or None
+
+
+def normalize(rows):
+    """
+    Строки листа в DataFrame с именованными колонками из COLUMNS.
+    """
+    width = max(COLUMNS.values()) + 1
+    df = pd.DataFrame([tuple(_[:width]) + (None,) * (width - len(_)) for _ in rows])
+    data = pd.DataFrame({name: df.iloc[:, index] for name, index in COLUMNS.items()})
+    for name in COLUMNS:
+        if name != 'weight':
+            data[name] = data[name].map(clean)
+    data['weight'] = pd.to_numeric(data['weight'], errors='coerce')
+    return data.dropna(how='all')
+
+
+def read_chunks(path, sheet='Лист1', chunk_size=CHUNK_SIZE):
+    """
+    Потоковое чтение листа фиксированными порциями, весь файл в память не загружается.
+    """
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        chunk = []
+        for row in workbook[sheet].iter_rows(min_row=FIRST_ROW, values_only=True):
+            chunk.append(row)
+            if len(chunk) >= chunk_size:
+                yield normalize(chunk)
+                chunk = []
+        if chunk:
+            yield normalize(chunk)
+    finally:
+        workbook.close()
+
+
+def unique_values(series):
+    return series.dropna().drop_duplicates().tolist()
+
+
+def import_names(model, values, field='name'):
+    """
+    Добавление в справочник отсутствующих значений: один запрос на чтение, одна пакетная вставка.
+    Счетчик ревизий справочника растет, по нему приложение сбрасывает кэш и сообщает ленте изменений.
+
+    :return: количество добавленных записей
+    """
+    attr = getattr(model, field)
+    existing = {_[0] for _ in session.query(attr)}
+    missing = [_ for _ in values if _ not in existing]
+    if missing:
+        session.bulk_insert_mappings(model, [{field: _} for _ in missing])
+        Revision.bump(model.__tablename__)
+    return len(missing)
+
+
+def import_transport(data):
+    pairs = data[['transport', 'transport_type']].dropna(subset=['transport']).drop_duplicates(subset=['transport'])
+    types = dict(session.query(TransportType.name, TransportType.id))
+    existing = {_[0] for _ in session.query(Transport.tag)}
+    missing = []
+    for tag, type_name in pairs.itertuples(index=False):
+        if tag not in existing:
+            missing.append(dict(tag=tag, type=types.get(type_name)))
+    if missing:
+        session.bulk_insert_mappings(Transport, missing)
+    return len(missing)
+
+
+def import_references(data):
+    stats = dict(
+        contragent=import_names(Contragent, unique_values(data['provider'])),
+        big=import_names(Big, unique_values(data['big'])),
+        package=import_names(Package, unique_values(data['package'])),
+        transport_type=import_names(TransportType, unique_values(data['transport_type'])),
+        port=import_names(Port, unique_values(data['port'])),
+        object=import_names(Object, unique_values(data['object']), field='id'),
+        doc_type=import_names(DocType, list(DOC_TYPES))
+    )
+    session.flush()
+    stats['transport'] = import_transport(data)
+    return stats
+
+
+def import_docs(data):
+    """
+    Документы движения и грузопозиции порции, сгруппированные по номеру документа.
+
+    Документ с уже существующим номером дополняется, грузопозиции с уже известным
+    номером сегмента пропускаются, поэтому повторный импорт файла не создает дублей.
+    """
+    data = data.dropna(subset=['doc_num', 'entity_class'])
+    if data.empty:
+        return dict(docs=0, entities=0)
+    contragents = dict(session.query(Contragent.name, Contragent.id))
+    bigs = dict(session.query(Big.name, Big.id))
+    packages = dict(session.query(Package.name, Package.id))
+    ports = dict(session.query(Port.name, Port.id))
+    transport_types = dict(session.query(TransportType.name, TransportType.id))
+    doc_type = session.query(DocType.id).filter_by(name=IMPORT_DOC_TYPE).scalar()
+    revision = Revision.bump(DOCS_REVISION)
+
+    nums = unique_values(data['doc_num'])
+    docs = dict(session.query(MovementDoc.tag, MovementDoc.id).filter(MovementDoc.tag.in_(nums)))
+    new_docs = []
+    for row in data.drop_duplicates(subset=['doc_num']).itertuples(index=False):
+        if row.doc_num in docs:
+            continue
+        new_docs.append(dict(
+            tag=row.doc_num,
+            type=doc_type,
+            sender=contragents.get(row.provider),
+            transport_type=transport_types.get(row.transport_type),
+            transport_tag=row.transport,
+            port=ports.get(row.port),
+            object=row.object,
+            big=bigs.get(row.big),
+            revision=revision
+        ))
+    if new_docs:
+        # Вставка одним executemany и одно чтение id: return_defaults вставлял бы по строке.
+        # Ревизия порции своя у каждой транзакции, по ней находятся только что вставленные строки.
+        session.execute(MovementDoc.__table__.insert(), new_docs)
+        docs.update(session.query(MovementDoc.tag, MovementDoc.id).filter(
+            MovementDoc.tag.in_([_['tag'] for _ in new_docs]), MovementDoc.revision == revision))
+
+    serials = unique_values(data['entity_serial'])
+    known = {_[0] for _ in session.query(Entity.segment_number).filter(Entity.segment_number.in_(serials))}
+    data = data[~data['entity_serial'].isin(known)]
+    data = data[data['entity_serial'].isna() | ~data['entity_serial'].duplicated()]
+
+    EntityClass.ensure(unique_values(data['entity_class']))
+    entities = []
+    for row in data.itertuples(index=False):
+        weight = None if pd.isna(row.weight) else float(row.weight)
+        entities.append(dict(
+            name=row.entity_class,
+            big=bigs.get(row.big),
+            package=packages.get(row.package),
+            segment_number=row.entity_serial,
+            weight=weight,
+            fu=weight,
+            input_doc=docs[row.doc_num],
+            revision=revision
+        ))
+    if not entities:
+        return dict(docs=len(new_docs), entities=0)
+    session.execute(Entity.__table__.insert(), entities)
+    touched = list({_['input_doc'] for _ in entities})
+    inserted = and_(Entity.input_doc.in_(touched), Entity.revision == revision)
+    Stock.apply(Stock.on_hand(inserted))
+    session.query(MovementDoc).filter(MovementDoc.id.in_(touched)) \
+        .update({MovementDoc.revision: revision}, synchronize_session=False)
+
+    # Id растут в порядке вставки, позиции в документе продолжают уже существующие
+    positions = dict(session.query(DocEntity.doc, func.max(DocEntity.position) + 1)
+                     .filter(DocEntity.doc.in_(touched)).group_by(DocEntity.doc))
+    links = []
+    for entity_id, doc_id in session.query(Entity.id, Entity.input_doc).filter(inserted).order_by(Entity.id):
+        position = positions.get(doc_id, 0)
+        positions[doc_id] = position + 1
+        links.append(dict(doc=doc_id, entity=entity_id, position=position))
+    session.bulk_insert_mappings(DocEntity, links)
+    return dict(docs=len(new_docs), entities=len(entities))
+
+
+def write_chunk(data):
+    try:
+        stats = import_references(data)
+        stats.update(import_docs(data))
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    return stats
+
+
+def add_stats(totals, stats):
+    for key, value in stats.items():
+        totals[key] = totals.get(key, 0) + value
+
+
+def import_file(path, sheet='Лист1', chunk_size=CHUNK_SIZE):
+    started = time.monotonic()
+    rows = 0
+    totals = {}
+    for data in read_chunks(path, sheet, chunk_size):
+        add_stats(totals, write_chunk(data))
+        rows += len(data)
+        LOGGER.log(logging.INFO, msg="%s: %s rows imported" % (path, rows))
+    elapsed = time.monotonic() - started
+    LOGGER.log(logging.INFO, msg="Imported %s rows from %s in %.1fs: %s" % (rows, path, elapsed, totals))
+    return totals
+
+
+def parse_file(path, sheet, chunk_size, queue, stop=None):
+    """
+    Разбор файла в процессе пула. Порции отправляются в очередь единственному писателю,
+    в конце отправляется маркер (path, None).
+
+    :param stop: Event, после которого разбор прекращается (писатель остановился с ошибкой)
+    """
+    started = time.monotonic()
+    rows = 0
+    try:
+        for data in read_chunks(path, sheet, chunk_size):
+            if stop is not None and stop.is_set():
+                break
+            data = data.drop_duplicates()
+            rows += len(data)
+            queue.put((path, data))
+    finally:
+        queue.put((path, None))
+    return rows, time.monotonic() - started
+
+
+def receive(queue, futures):
+    """
+    Порции из очереди, пока не придут маркеры всех файлов.
+
+    Файл, разбор которого завершился, а маркера в очереди нет (процесс пула убит, задача отменена),
+    больше не ожидается: иначе писатель ждал бы его вечно.
+    """
+    pending = set(futures)
+    while pending:
+        # Маркер отправляется до завершения задачи, поэтому завершенные до ожидания задачи без маркера
+        # в пустой очереди его уже не пришлют
+        finished = {_ for _ in pending if futures[_].done()}
+        try:
+            path, data = queue.get(timeout=QUEUE_TIMEOUT)
+        except Empty:
+            pending -= finished
+            continue
+        if data is None:
+            pending.discard(path)
+        else:
+            yield path, data
+
+
+def expand(patterns):
+    files = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            files.extend(sorted(glob.glob(os.path.join(pattern, '*.xlsx'))))
+        else:
+            files.extend(sorted(glob.glob(pattern)) or [pattern])
+    return [_ for _ in files if not os.path.basename(_).startswith('~$')]
+
+
+def import_files(files, sheet='Лист1', chunk_size=CHUNK_SIZE, workers=None, queue_size=4):
+    """
+    Параллельный разбор файлов в пуле процессов (xlsx упирается в CPU) и запись
+    в БД единственным писателем в текущем процессе.
+    """
+    started = time.monotonic()
+    totals = {}
+    written = {_: 0 for _ in files}
+    write_time = {_: 0.0 for _ in files}
+    with Manager() as manager, ProcessPoolExecutor(max_workers=workers) as pool:
+        queue = manager.Queue(maxsize=queue_size)
+        stop = manager.Event()
+        futures = {_: pool.submit(parse_file, _, sheet, chunk_size, queue, stop) for _ in files}
+        chunks = receive(queue, futures)
+        try:
+            for path, data in chunks:
+                chunk_started = time.monotonic()
+                add_stats(totals, write_chunk(data))
+                write_time[path] += time.monotonic() - chunk_started
+                written[path] += len(data)
+        except BaseException:
+            # Процессы пула заблокированы на put в ограниченную очередь, и выход из with ждал бы их
+            # вечно: неначатые файлы отменяются, начатые дочитываются из очереди до маркера
+            stop.set()
+            pool.shutdown(wait=False, cancel_futures=True)
+            for _ in chunks:
+                pass
+            raise
+
+    rows = 0
+    for path, future in futures.items():
+        try:
+            parsed, parse_time = future.result()
+        except Exception as e:
+            LOGGER.log(logging.ERROR, msg="%s: failed to parse: %s" % (path, e))
+            continue
+        rows += written[path]
+        LOGGER.log(logging.INFO, msg="%s: %s rows, parse %.0f rows/s, write %.0f rows/s" % (
+            path, written[path], parsed / parse_time if parse_time else 0,
+            written[path] / write_time[path] if write_time[path] else 0))
+    elapsed = time.monotonic() - started
+    LOGGER.log(logging.INFO, msg="Imported %s rows from %s files in %.1fs (%.0f rows/s): %s" % (
+        rows, len(files), elapsed, rows / elapsed if elapsed else 0, totals))
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Импорт отчетов движения из xlsx")
+    parser.add_argument('paths', nargs='*', default=['otchet.xlsx'], help="файлы, каталоги или маски")
+    parser.add_argument('--sheet', default='Лист1')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    parser.add_argument('--workers', type=int, default=None, help="процессов для разбора, по умолчанию по числу ядер")
+    args = parser.parse_args()
+
+    files = expand(args.paths)
+    if not files:
+        parser.error("no files found")
+    init_db()
+    import_files(files, args.sheet, args.chunk_size, args.workers)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,235 @@
+"""
+Фоновая загрузка документов движения.
+
+PUT /api/v1/doc?async=1 проверяет тело, записывает задание в ingest_job и отвечает 202 с id задания,
+документ с грузопозициями записывает воркер из ограниченной очереди процесса. Очередь хранит только
+id заданий: состояние (GET /api/v1/job/{id}) видно из любого процесса, а задания, не взятые в работу
+до остановки, снова ставятся в очередь при старте.
+"""
+import json
+import asyncio
+from datetime import datetime, timedelta
+
+from sqlalchemy.exc import SQLAlchemyError
+from starlette.concurrency import run_in_threadpool
+
+import logging
+from logs import get_logger
+
+from database import session_scope, MovementDoc, Entity, IngestJob, JOB_DONE, JOB_FAILED
+from metrics import INGEST_QUEUE, INGEST_JOBS
+from responses import dumps
+
+LOGGER = get_logger()
+
+INGEST_QUEUE_SIZE = 100
+INGEST_WORKERS = 1
+INGEST_RETENTION_DAYS = 7
+# Задание в работе дольше этого снова ставится в очередь при старте: выполнявший его процесс остановился
+INGEST_STALE_MINUTES = 10
+
+DOC_FIELDS = ('type', 'port', 'sender', 'receiver', 'place', 'transport_type', 'object', 'danger_class', 'big',
+              'transport_tag', 'tag', 'send_date', 'receive_date', 'extra', 'contract', 'entities')
+ENTITY_FIELDS = ('name', 'inplace_count', 'pipe_tag', 'weight', 'length', 'segment_number', 'diameter',
+                 'thickness', 'place_number', 'extra')
+# Без fu Entity вычисляет его из этих полей
+FU_FIELDS = ('weight', 'length', 'diameter')
+
+
+def build_doc(req):
+    """
+    Документ и грузопозиции из тела PUT /api/v1/doc без записи в БД.
+
+    KeyError - нет обязательного поля, ValueError - некорректная дата.
+    """
+    doc = MovementDoc(
+        type=req['type'],
+        port=req['port'],
+        sender=req['sender'],
+        receiver=req['receiver'],
+        place=req['place'],
+        transport_type=req['transport_type'],
+        object=req['object'],
+        danger_class=req["danger_class"],
+        big=req["big"],
+        transport_tag=req["transport_tag"],
+        tag=req["tag"],
+        send_date=datetime.strptime(req["send_date"], "%Y-%m-%d"),
+        receive_date=datetime.strptime(req["receive_date"], "%Y-%m-%d"),
+        extra=req["extra"],
+        contract=req["contract"]
+    )
+    entities = []
+    for _ in req["entities"]:
+        entities.append(Entity(
+            name=_['name'],
+            big=doc.big,
+            inplace_count=_['inplace_count'],
+            package=_['pipe_tag'],
+            weight=_['weight'],
+            height=_['length'],
+            segment_number=_['segment_number'],
+            diameter=_['diameter'],
+            thickness=_['thickness'],
+            place_number=_['place_number'],
+            extra=_['extra'],
+            fu=_.get('fu')
+        ))
+    return doc, entities
+
+
+def validate_doc(req):
+    """
+    Проверки build_doc без создания объектов моделей, которое на больших документах дороже самой проверки.
+    """
+    for _ in DOC_FIELDS:
+        if _ not in req:
+            raise KeyError(_)
+    if not req['entities']:
+        raise ValueError("Empty entities")
+    datetime.strptime(req["send_date"], "%Y-%m-%d")
+    datetime.strptime(req["receive_date"], "%Y-%m-%d")
+    fields = set(ENTITY_FIELDS)
+    for number, entity in enumerate(req['entities']):
+        missing = fields.difference(entity)
+        if missing:
+            raise KeyError(*sorted(missing))
+        if entity.get('fu'):
+            continue
+        for _ in FU_FIELDS:
+            try:
+                float(entity[_])
+            except (TypeError, ValueError):
+                raise ValueError("Entity %s: %s is not a number" % (number, _))
+
+
+def create_job(message, key=None):
+    """
+    Проверка тела документа и запись задания.
+
+    :param key: Idempotency-Key, повтор с тем же ключом возвращает уже созданное задание без проверки тела
+    :return: (задание, True если создано)
+    """
+    if key is not None:
+        job = IngestJob.get_by_key(key)
+        if job is not None:
+            return job.serialized, False
+    validate_doc(message)
+    job, created = IngestJob.create(key, dumps(message).decode('utf-8'), len(message['entities']))
+    return job.serialized, created
+
+
+def run_job(job_id):
+    with session_scope():
+        claimed = IngestJob.claim(job_id)
+        if claimed is None:
+            # Уже выполнено или выполняется воркером другого процесса
+            return None
+        job = IngestJob.get(job_id)
+        try:
+            doc, entities = build_doc(json.loads(job.payload))
+            doc.save_with_entities(entities, job=job_id, claimed=claimed)
+        except Exception as e:
+            LOGGER.log(logging.ERROR, msg="Ingest job %s failed: %s" % (job_id, e.args))
+            # e.args без текста SQL и параметров, которые SQLAlchemy добавляет в str(e).
+            # Если не записался и статус, задание остается running и снова ставится в очередь при старте
+            if not IngestJob.finish(job_id, claimed,
+                                    error='%s: %s' % (type(e).__name__, ', '.join(str(_) for _ in e.args))):
+                # Задание вернули в очередь, пока шла загрузка, и его выполняет другой воркер
+                return None
+            INGEST_JOBS.labels(JOB_FAILED).inc()
+            return JOB_FAILED
+        INGEST_JOBS.labels(JOB_DONE).inc()
+        LOGGER.log(logging.INFO, msg="Ingest job %s: created doc %s with %s entities" % (job_id, doc.id, len(entities)))
+        return JOB_DONE
+
+
+def recover(limit, retention, stale=INGEST_STALE_MINUTES):
+    """
+    Задания queued из прошлых запусков, в том числе running дольше stale минут,
+    и очистка завершенных старше retention дней.
+
+    :return: id заданий для очереди, не больше limit
+    """
+    with session_scope():
+        try:
+            if retention:
+                IngestJob.purge(datetime.now() - timedelta(days=retention))
+            if stale:
+                released = IngestJob.release(datetime.now() - timedelta(minutes=stale))
+                if released:
+                    LOGGER.log(logging.WARNING, msg="%s stale running ingest jobs requeued" % released)
+            return IngestJob.pending(limit)
+        except SQLAlchemyError as e:
+            LOGGER.log(logging.WARNING, msg="Ingest jobs are not recovered, run migrations.py: %s" % e.args)
+            return []
+
+
+class IngestQueue(object):
+    """
+    Ограниченная очередь заданий процесса и воркеры, которые ее разбирают.
+
+    Запись в SQLite идет одним писателем, поэтому по умолчанию воркер один: больше воркеров
+    имеет смысл для Postgres.
+    """
+
+    def __init__(self):
+        self.queue = None
+        self.workers = []
+
+    @property
+    def running(self):
+        return self.queue is not None
+
+    def full(self):
+        return self.queue is None or self.queue.full()
+
+    async def start(self, size=INGEST_QUEUE_SIZE, workers=INGEST_WORKERS, retention=INGEST_RETENTION_DAYS,
+                    stale=INGEST_STALE_MINUTES):
+        self.queue = asyncio.Queue(maxsize=size)
+        for job_id in await run_in_threadpool(recover, size, retention, stale):
+            self.queue.put_nowait(job_id)
+        INGEST_QUEUE.set(self.queue.qsize())
+        self.workers = [asyncio.ensure_future(self.work()) for _ in range(max(workers, 1))]
+
+    async def stop(self):
+        # Задание, уже начатое в потоке пула, дописывается; оставшиеся в очереди остаются queued в БД
+        for _ in self.workers:
+            _.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+        self.queue = None
+
+    def submit(self, job_id):
+        """
+        :return: False, если очередь заполнена или не запущена
+        """
+        if self.queue is None:
+            return False
+        try:
+            self.queue.put_nowait(job_id)
+        except asyncio.QueueFull:
+            return False
+        INGEST_QUEUE.set(self.queue.qsize())
+        return True
+
+    async def work(self):
+        while True:
+            job_id = await self.queue.get()
+            INGEST_QUEUE.set(self.queue.qsize())
+            try:
+                await run_in_threadpool(run_job, job_id)
+            except Exception as e:
+                LOGGER.log(logging.ERROR, msg="Ingest job %s: %s" % (job_id, e.args))
+            finally:
+                self.queue.task_done()
+
+    async def join(self):
+        """
+        Ожидание, пока очередь не опустеет (бенчмарки, тесты).
+        """
+        if self.queue is not None:
+            await self.queue.join()
+
+
+ingest_queue = IngestQueue()
@@ -0,0 +1,149 @@
+import time
+from contextvars import ContextVar
+
+import logging
+from logs import get_logger
+
+from prometheus_client import Counter, Gauge, Histogram, REGISTRY, CONTENT_TYPE_LATEST, generate_latest
+from prometheus_client.core import GaugeMetricFamily
+from sqlalchemy import event
+from starlette.routing import Match
+
+LOGGER = get_logger()
+
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+QUERY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+REQUEST_LATENCY = Histogram('proton_request_duration_seconds', 'Request latency', ['method', 'route'])
+REQUESTS_IN_FLIGHT = Gauge('proton_requests_in_flight', 'Requests being processed', ['method', 'route'])
+RESPONSES = Counter('proton_responses_total', 'Responses by status', ['method', 'route', 'status'])
+RESPONSE_SIZE = Histogram('proton_response_size_bytes', 'Response body size', ['method', 'route'],
+                          buckets=SIZE_BUCKETS)
+QUERY_LATENCY = Histogram('proton_db_query_duration_seconds', 'SQL statement latency', ['statement'],
+                          buckets=QUERY_BUCKETS)
+REQUEST_QUERIES = Histogram('proton_db_queries_per_request', 'SQL statements per request', ['method', 'route'],
+                            buckets=COUNT_BUCKETS)
+INGEST_QUEUE = Gauge('proton_ingest_queue_depth', 'Ingest jobs waiting in the process queue')
+INGEST_JOBS = Counter('proton_ingest_jobs_total', 'Finished ingest jobs by status', ['status'])
+CHANGES_SUBSCRIBERS = Gauge('proton_changes_subscribers', 'Connected change feed clients')
+CHANGES_RESETS = Counter('proton_changes_resets_total', 'Change feed resets sent to lagging clients')
+
+query_stats = ContextVar('query_stats', default=None)
+
+
+class QueryStats(object):
+    """
+    Счетчик SQL-запросов текущего HTTP-запроса.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+
+
+def statement_type(statement):
+    return statement.lstrip().split(None, 1)[0].upper() if statement else 'UNKNOWN'
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_start'].pop()
+    QUERY_LATENCY.labels(statement_type(statement)).observe(elapsed)
+    stats = query_stats.get()
+    if stats is not None:
+        stats.count += 1
+        stats.duration += elapsed
+
+
+class PoolCollector(object):
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    def collect(self):
+        pool = self.engine.pool
+        for name, doc in (('size', 'Pool size'), ('checkedin', 'Idle connections'),
+                          ('checkedout', 'Connections in use'), ('overflow', 'Overflow connections')):
+            method = getattr(pool, name, None)
+            if method is None:
+                continue
+            gauge = GaugeMetricFamily('proton_db_pool_%s' % name, doc)
+            gauge.add_metric([], method())
+            yield gauge
+
+
+def instrument_engine(engine):
+    # Повторный старт приложения в том же процессе (тесты, бенчмарки) не должен дублировать слушателей
+    if event.contains(engine, 'before_cursor_execute', before_cursor_execute):
+        return
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+    REGISTRY.register(PoolCollector(engine))
+
+
+def route_path(scope):
+    for route in scope['app'].router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+    return 'unmatched'
+
+
+class MetricsMiddleware(object):
+    """
+    Задержка, размер ответа, запросы в обработке и число SQL-запросов по маршрутам.
+
+    :param query_headers: добавлять в ответ X-Query-Count и X-DB-Time (мс)
+    :param query_budget: предупреждение в лог, если запрос сделал больше SQL-запросов
+    """
+
+    def __init__(self, app, query_headers=False, query_budget=None):
+        self.app = app
+        self.query_headers = query_headers
+        self.query_budget = query_budget
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        method = scope['method']
+        route = route_path(scope)
+        response = dict(status=500, size=0)
+
+        async def send_wrapper(message):
+            if message['type'] == 'http.response.start':
+                response['status'] = message['status']
+                if self.query_headers:
+                    message['headers'] = list(message.get('headers', [])) + [
+                        (b'x-query-count', str(stats.count).encode()),
+                        (b'x-db-time', ('%.1f' % (stats.duration * 1000)).encode())
+                    ]
+            elif message['type'] == 'http.response.body':
+                response['size'] += len(message.get('body', b''))
+            await send(message)
+
+        stats = QueryStats()
+        token = query_stats.set(stats)
+        in_flight = REQUESTS_IN_FLIGHT.labels(method, route)
+        in_flight.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            REQUEST_LATENCY.labels(method, route).observe(time.perf_counter() - started)
+            in_flight.dec()
+            query_stats.reset(token)
+            RESPONSES.labels(method, route, str(response['status'])).inc()
+            RESPONSE_SIZE.labels(method, route).observe(response['size'])
+            REQUEST_QUERIES.labels(method, route).observe(stats.count)
+            if self.query_budget is not None and stats.count > self.query_budget:
+                LOGGER.log(logging.WARNING, msg="Query budget exceeded: %s %s made %s queries in %.1f ms (budget %s)"
+                           % (method, scope['path'], stats.count, stats.duration * 1000, self.query_budget))
+
+
+def render():
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
@@ -0,0 +1,167 @@
+"""
+Разовые миграции схемы.
+
+    python migrations.py
+"""
+import json
+
+from sqlalchemy import inspect, text
+
+import logging
+from logs import get_logger
+
+from database import get_engine, init_db, Entity, DocEntity, MovementDoc, Stock, create_search_index
+from stock import rebuild as rebuild_stock
+
+LOGGER = get_logger()
+
+BATCH_SIZE = 10000
+# Одноколоночные индексы, замененные составными с id
+REPLACED_INDEXES = dict(entity=('ix_entity_name', 'ix_entity_package', 'ix_entity_input_doc'))
+
+
+def migrate_doc_entities():
+    """
+    Перенос списков грузопозиций из JSON-колонки movement_doc.entities в таблицу movement_doc_entity.
+
+    Перенесенные строки обнуляются, поэтому повторный запуск безопасен.
+    """
+    columns = [_['name'] for _ in inspect(get_engine()).get_columns('movement_doc')]
+    if 'entities' not in columns:
+        return 0
+    migrated = 0
+    with get_engine().begin() as conn:
+        existing = {_[0] for _ in conn.execute(Entity.__table__.select().with_only_columns([Entity.id]))}
+        rows = conn.execute(text("SELECT id, entities FROM movement_doc WHERE entities IS NOT NULL")).fetchall()
+        batch = []
+        for doc_id, entities in rows:
+            try:
+                ids = json.loads(entities)
+            except ValueError:
+                LOGGER.log(logging.ERROR, msg="Doc %s has broken entity list: %s" % (doc_id, entities))
+                continue
+            for position, entity_id in enumerate(_ for _ in ids if int(_) in existing):
+                batch.append(dict(doc=doc_id, entity=int(entity_id), position=position))
+            if len(batch) >= BATCH_SIZE:
+                conn.execute(DocEntity.__table__.insert(), batch)
+                batch = []
+            migrated += 1
+        if batch:
+            conn.execute(DocEntity.__table__.insert(), batch)
+        conn.execute(text("UPDATE movement_doc SET entities = NULL WHERE entities IS NOT NULL"))
+    LOGGER.log(logging.INFO, msg="Migrated entity lists of %s docs" % migrated)
+    return migrated
+
+
+def add_revision_columns():
+    """
+    Колонка revision для ETag в таблицах, созданных до ее появления.
+    """
+    added = []
+    with get_engine().begin() as conn:
+        for table in ('movement_doc', 'entity'):
+            columns = [_['name'] for _ in inspect(conn).get_columns(table)]
+            if 'revision' not in columns:
+                conn.execute(text("ALTER TABLE %s ADD COLUMN revision INTEGER NOT NULL DEFAULT 0" % table))
+                added.append(table)
+    LOGGER.log(logging.INFO, msg="Revision column added to: %s" % (', '.join(added) or 'none'))
+    return added
+
+
+def add_job_claimed_column():
+    """
+    Время взятия задания в работу для ingest_job, созданной до его появления.
+    """
+    with get_engine().begin() as conn:
+        columns = [_['name'] for _ in inspect(conn).get_columns('ingest_job')]
+        if 'claimed' in columns:
+            return False
+        conn.execute(text("ALTER TABLE ingest_job ADD COLUMN claimed TIMESTAMP"))
+    LOGGER.log(logging.INFO, msg="Claimed column added to ingest_job")
+    return True
+
+
+def sync_revision_sequence():
+    """
+    revision_seq (Postgres) продолжает ревизии, выданные счетчиком до ее появления: иначе пара
+    (id, revision) и ETag списка могли бы повториться.
+    """
+    with get_engine().begin() as conn:
+        if conn.dialect.name != 'postgresql':
+            return
+        conn.exec_driver_sql(
+            "SELECT setval('revision_seq', greatest((SELECT coalesce(max(value), 0) FROM revision), "
+            "(SELECT last_value FROM revision_seq)))")
+    LOGGER.log(logging.INFO, msg="Revision sequence is in sync")
+
+
+def create_indexes():
+    """
+    Индексы, объявленные в моделях после создания таблиц: create_all добавляет их только в новые таблицы.
+    Замененные индексы удаляются после создания новых.
+    """
+    created = []
+    dropped = []
+    with get_engine().begin() as conn:
+        for model in (Entity, MovementDoc, DocEntity):
+            existing = {_['name'] for _ in inspect(conn).get_indexes(model.__tablename__)}
+            for index in model.__table__.indexes:
+                if index.name not in existing:
+                    index.create(bind=conn)
+                    created.append(index.name)
+            for name in REPLACED_INDEXES.get(model.__tablename__, ()):
+                if name in existing:
+                    conn.execute(text("DROP INDEX %s" % name))
+                    dropped.append(name)
+    LOGGER.log(logging.INFO, msg="Indexes created: %s, dropped: %s" % (', '.join(created) or 'none',
+                                                                      ', '.join(dropped) or 'none'))
+    return created
+
+
+def unique_stock_group():
+    """
+    Уникальный ix_stock_group по coalesce колонок группы вместо прежнего неуникального индекса.
+
+    Сводка с возможными дублями групп очищается, ее заново заполняет rebuild_stock.
+    """
+    with get_engine().begin() as conn:
+        # Индексы по выражениям inspect не отражает, определение читается из каталога
+        if conn.dialect.name == 'postgresql':
+            query = "SELECT indexdef FROM pg_indexes WHERE indexname = 'ix_stock_group'"
+        else:
+            query = "SELECT sql FROM sqlite_master WHERE type = 'index' AND name = 'ix_stock_group'"
+        definition = conn.exec_driver_sql(query).scalar()
+        if definition and 'coalesce' in definition.lower():
+            return False
+        if definition:
+            conn.execute(text("DROP INDEX ix_stock_group"))
+        conn.execute(Stock.__table__.delete())
+        for index in Stock.__table__.indexes:
+            if index.name == 'ix_stock_group':
+                index.create(bind=conn)
+    LOGGER.log(logging.INFO, msg="Stock group index is unique, stock is cleared until rebuild")
+    return True
+
+
+def create_entity_search():
+    """
+    Индекс подсказок по грузопозициям для базы, созданной до его появления, с заполнением по текущим данным.
+    """
+    with get_engine().begin() as conn:
+        create_search_index(Entity.__table__, conn)
+        if conn.dialect.name == 'sqlite':
+            conn.exec_driver_sql("INSERT INTO entity_fts(entity_fts) VALUES ('rebuild')")
+    LOGGER.log(logging.INFO, msg="Entity search index is ready")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    init_db()
+    add_revision_columns()
+    add_job_claimed_column()
+    sync_revision_sequence()
+    migrate_doc_entities()
+    create_indexes()
+    create_entity_search()
+    unique_stock_group()
+    rebuild_stock()
@@ -0,0 +1,165 @@
+import zlib
+
+import orjson
+
+from fastapi.encoders import jsonable_encoder
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.responses import JSONResponse
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS
+
+# Уже сжатые форматы: повторное сжатие только тратит CPU
+COMPRESSED_TYPES = (
+    'application/zip',
+    'application/gzip',
+    'application/vnd.openxmlformats-officedocument.',
+    'application/vnd.apache.parquet',
+    'image/',
+    # События ленты изменений мелкие, а сжатие потока держит компрессор на каждого подключенного клиента
+    'text/event-stream',
+)
+
+
+def encode_default(obj):
+    return jsonable_encoder(obj)
+
+
+def dumps(content):
+    return orjson.dumps(content, default=encode_default, option=ORJSON_OPTIONS)
+
+
+class FastJSONResponse(JSONResponse):
+    """
+    JSON-ответ через orjson: datetime и float кодируются нативно, без обхода jsonable_encoder.
+    """
+
+    def render(self, content):
+        return dumps(content)
+
+
+def negotiate(accept_encoding):
+    accepted = {}
+    for item in accept_encoding.split(','):
+        parts = item.strip().split(';')
+        name = parts[0].strip().lower()
+        quality = 1.0
+        for param in parts[1:]:
+            key, _, value = param.strip().partition('=')
+            if key == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if name:
+            accepted[name] = quality
+    if brotli is not None and accepted.get('br', 0) > 0:
+        return 'br'
+    if accepted.get('gzip', 0) > 0:
+        return 'gzip'
+    return None
+
+
+class Compressor(object):
+
+    def __init__(self, encoding, level):
+        self.encoding = encoding
+        if encoding == 'br':
+            self.compressor = brotli.Compressor(quality=level)
+        else:
+            self.compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def chunk(self, data):
+        if self.encoding == 'br':
+            return self.compressor.process(data) + self.compressor.flush()
+        return self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self, data=b''):
+        if self.encoding == 'br':
+            return self.compressor.process(data) + self.compressor.finish()
+        return self.compressor.compress(data) + self.compressor.flush()
+
+
+class CompressionMiddleware(object):
+    """
+    Сжатие ответов больше minimum_size: brotli, если установлен и поддерживается клиентом, иначе gzip.
+
+    Потоковые ответы сжимаются по частям, каждая часть сбрасывается клиенту сразу.
+    """
+
+    def __init__(self, app, minimum_size=1024, level=5):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.level = level
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http':
+            encoding = negotiate(Headers(scope=scope).get('accept-encoding', ''))
+            if encoding:
+                responder = CompressionResponder(self.app, encoding, self.minimum_size, self.level)
+                await responder(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
+
+
+class CompressionResponder(object):
+
+    def __init__(self, app, encoding, minimum_size, level):
+        self.app = app
+        self.encoding = encoding
+        self.minimum_size = minimum_size
+        self.level = level
+        self.send = None
+        self.start_message = None
+        self.compressor = None
+        self.passthrough = False
+
+    async def __call__(self, scope, receive, send):
+        self.send = send
+        await self.app(scope, receive, self.send_compressed)
+
+    async def send_compressed(self, message):
+        if message['type'] == 'http.response.start':
+            self.start_message = message
+            return
+        if message['type'] != 'http.response.body':
+            await self.send(message)
+            return
+
+        body = message.get('body', b'')
+        more_body = message.get('more_body', False)
+        if self.passthrough:
+            await self.send(message)
+            return
+
+        if self.compressor is None:
+            headers = MutableHeaders(raw=self.start_message['headers'])
+            if 'content-encoding' in headers or self.start_message['status'] in (204, 304) or \
+                    headers.get('content-type', '').startswith(COMPRESSED_TYPES) or \
+                    (not more_body and len(body) < self.minimum_size):
+                self.passthrough = True
+                await self.send(self.start_message)
+                await self.send(message)
+                return
+            self.compressor = Compressor(self.encoding, self.level)
+            headers['Content-Encoding'] = self.encoding
+            headers.add_vary_header('Accept-Encoding')
+            if more_body:
+                del headers['Content-Length']
+                body = self.compressor.chunk(body)
+            else:
+                body = self.compressor.finish(body)
+                headers['Content-Length'] = str(len(body))
+            await self.send(self.start_message)
+            await self.send(dict(type='http.response.body', body=body, more_body=more_body))
+            return
+
+        if more_body:
+            body = self.compressor.chunk(body)
+        else:
+            body = self.compressor.finish(body)
+        await self.send(dict(type='http.response.body', body=body, more_body=more_body))
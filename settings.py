@@ -29,9 +29,11 @@ class Settings(object):
             self.first_start = False
         else:
             self.config.add_section('empty')
-            if not os.path.exists(os.path.dirname(self.path)):
-                os.mkdir(os.path.dirname(self.path))
-            self.config.write(self.path)
+            self.first_start = True
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            self.commit()
 
     def set(self, section, parameter, value):
         if self.config.has_section(section=section):
@@ -60,3 +62,29 @@ class Settings(object):
         else:
             response = None
         return response
+
+    def get_int(self, section, parameter, default=None):
+        value = self.get(section, parameter)
+        if value is None or value is False or value == '':
+            return default
+        try:
+            return int(value)
+        except ValueError:
+            LOGGER.log(level=logging.ERROR, msg='Invalid integer %s.%s: %s' % (section, parameter, value))
+            return default
+
+    def get_float(self, section, parameter, default=None):
+        value = self.get(section, parameter)
+        if value is None or value is False or value == '':
+            return default
+        try:
+            return float(value)
+        except ValueError:
+            LOGGER.log(level=logging.ERROR, msg='Invalid number %s.%s: %s' % (section, parameter, value))
+            return default
+
+    def get_bool(self, section, parameter, default=False):
+        value = self.get(section, parameter)
+        if value is None or value is False or value == '':
+            return default
+        return value.strip().lower() in ('1', 'true', 'yes', 'on')
@@ -0,0 +1,27 @@
+"""
+Пересчет сводки остатков с нуля, если она разошлась с грузопозициями
+(ручные правки базы, запись в обход документов движения).
+
+    python stock.py
+"""
+import time
+
+import logging
+from logs import get_logger
+
+from database import session_scope, Stock
+
+LOGGER = get_logger()
+
+
+def rebuild():
+    started = time.monotonic()
+    with session_scope():
+        groups = Stock.rebuild()
+    LOGGER.log(logging.INFO, msg="Stock rebuilt: %s groups in %.1fs" % (groups, time.monotonic() - started))
+    return groups
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    rebuild()